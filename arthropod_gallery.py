@@ -1,13 +1,57 @@
 import sys
 import os
-from PyQt6.QtWidgets import (QApplication, QLabel, QLineEdit, QWidget, QVBoxLayout, QGridLayout,
-                             QPushButton, QStackedWidget, QSizePolicy, QCompleter, QMainWindow,
-                             QGraphicsView, QGraphicsScene,QGraphicsLineItem, QGraphicsTextItem,
-                             QGraphicsRectItem, QFileDialog)
-from PyQt6.QtGui import QIcon, QFont, QPixmap, QFontMetrics
-from PyQt6.QtCore import Qt
 import sqlite3
-import shutil
+from PyQt6.QtWidgets import (QApplication, QLabel, QLineEdit, QWidget, QVBoxLayout,
+                             QPushButton, QStackedWidget, QSizePolicy, QCompleter, QMainWindow,
+                             QGraphicsView, QGraphicsScene,QGraphicsLineItem,
+                             QGraphicsRectItem, QFileDialog, QScrollArea, QListView, QComboBox, QHBoxLayout,
+                             QProgressBar, QMenu, QMessageBox)
+from PyQt6.QtGui import QIcon, QFont, QPixmap, QFontMetrics, QImageReader, QImage, QColor, QPen
+from PyQt6.QtCore import (Qt, QObject, QRunnable, QThreadPool, pyqtSignal, QAbstractListModel,
+                          QModelIndex, QSize, QRectF, QTimer)
+import math
+import threading
+import argparse
+from collections import OrderedDict
+from contextlib import contextmanager
+import instrumentation
+from instrumentation import timed, span, count
+from thumbnail_cache import get_thumbnail_cache, get_thumbnail_cache_dir
+from database import get_database, close_all_databases, open_read_only, table_exists
+from photo_database import (create_photo_database, add_photo, delete_photo, open_photo_database,
+                            get_photo_database_path, get_photo_folder_path, record_photo_taxa,
+                            default_taxonomy_database_path, get_cameras, get_photo_database_version)
+from taxon_search import search_taxons, find_taxon_ids, has_taxon_search_index
+from taxon_tree import (get_entries_with_photos, get_photo_counts, get_direct_photo_counts, get_entry_ancestors,
+                        build_taxon_tree, get_subtree_photo_taxa, get_taxonomy_stamp)
+from tree_layout import (layout_tree, get_node_label, get_collapsed_nodes, get_layout_bounds,
+                         TreeLayoutIndex)
+from tree_cache import get_tree_cache_path, read_tree_cache, write_tree_cache
+
+# Subtrees at or below this rank start collapsed in the tree view
+default_collapse_rank = "family"
+# Zoom level below which node labels are not drawn
+text_level_of_detail = 0.4
+
+# Tree view geometry
+tree_font_family = "Arial"
+tree_font_size = 10
+tree_level_height = 75
+tree_sibling_spacing = 50
+tree_expander_size = 14
+
+# Stages of loading the tree view, reported as progress while they run off the GUI thread
+tree_load_stages = ("Recording photo lineages", "Reading photos", "Finding ancestors", "Building tree",
+                    "Laying out tree")
+# SQLite virtual machine instructions between checks for a cancelled load
+cancel_check_interval = 10000
+
+def get_heat_color(photo_count, max_photo_count):
+    # Pale yellow for a single photo through to red for the most photographed subtree, on a log scale
+    if photo_count <= 0:
+        return QColor(Qt.GlobalColor.lightGray)
+    heat = min(1.0, math.log1p(photo_count) / math.log1p(max(max_photo_count, 1)))
+    return QColor.fromHsvF((1 - heat) / 6, 0.25 + 0.75 * heat, 1.0)
 
 def check_if_database_exists(database_name):
     base_dir = os.path.dirname(__file__)
@@ -17,33 +61,9 @@ def check_if_database_exists(database_name):
     else:
         return False
 
-def create_photo_database(database_name):
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    database_path = os.path.join(base_dir, 'databases', database_name + '.db')
-    database_folder_path = os.path.join(base_dir, 'databases')
-    os.makedirs(database_folder_path, exist_ok=True)
-
-    taxonomy = sqlite3.connect(database_path)
-    cursor = taxonomy.cursor()
-    cursor.execute("PRAGMA foreign_keys = ON;")
-
-    # Create photos table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS photos (
-        photo_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        taxon_id INTEGER NOT NULL,
-        filepath TEXT NOT NULL,
-        FOREIGN KEY(taxon_id) REFERENCES taxons(taxon_id) ON DELETE CASCADE
-    )
-    ''')
-
-    taxonomy.commit()
-    taxonomy.close()
-
-def upload_image(database_name, taxon_id, button=None):
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    database_path = os.path.join(base_dir, 'databases', database_name + '.db')
-    photo_folder_path = os.path.join(base_dir, 'images', database_name)
+def upload_image(database_name, taxon_id, button=None, taxonomy_database_path=default_taxonomy_database_path):
+    database_path = get_photo_database_path(database_name)
+    photo_folder_path = get_photo_folder_path(database_name)
 
     os.makedirs(photo_folder_path, exist_ok=True)
     file_path, _ = QFileDialog.getOpenFileName(
@@ -54,254 +74,843 @@ def upload_image(database_name, taxon_id, button=None):
     )
     if not file_path:
         return
-    photo_name = os.path.basename(file_path)
-    photo_path = os.path.join(photo_folder_path, photo_name)
-    shutil.copy(file_path, photo_path)
-
-    connection = sqlite3.connect(database_path)
-    photo_cursor = connection.cursor()
-    photo_cursor.execute(
-        "INSERT INTO photos (taxon_id, filepath) VALUES (?, ?)",
-        (taxon_id, photo_path)
+
+    return add_photo(database_path, taxon_id, file_path, photo_folder_path, taxonomy_database_path)
+
+class TreeLoadCancelled(Exception):
+    pass
+
+class TreeMetrics:
+    # Font and label widths of the tree view. Text measurement only, no widgets, so it can be
+    # created on the loading thread and handed over to the window with the layout.
+    def __init__(self):
+        self.font = QFont(tree_font_family, tree_font_size)
+        self.font_metrics = QFontMetrics(self.font)
+        self.label_widths = {}
+        self.entry_box_height = self.font_metrics.height() + 10
+
+    def label_width(self, node):
+        # Measured once per label
+        label = get_node_label(node)
+        text_width = self.label_widths.get(label)
+        if text_width is None:
+            count("label_measurements")
+            text_width = self.font_metrics.horizontalAdvance(label) + 20
+            self.label_widths[label] = text_width
+        return text_width
+
+class LoadedTree:
+    # What the tree window needs that doesn't have to be computed on the GUI thread
+    def __init__(self, tree_data, collapsed_nodes, tree_metrics, layout_nodes):
+        self.tree_data = tree_data
+        self.collapsed_nodes = collapsed_nodes
+        self.tree_metrics = tree_metrics
+        self.layout_nodes = layout_nodes
+
+def lay_out_taxon_tree(tree_data, collapsed_nodes, tree_metrics):
+    return layout_tree(
+        tree_data, tree_metrics.label_width, tree_metrics.entry_box_height,
+        tree_level_height, tree_sibling_spacing, tree_sibling_spacing,
+        lambda node: node.id not in collapsed_nodes
     )
-    connection.commit()
-    connection.close()
-
-def get_entries_with_photos(cursor):
-    cursor.execute("SELECT DISTINCT taxon_id FROM photos")
-    rows = cursor.fetchall()
-    entries_with_photos = set()
-    for row in rows:
-        taxon_id = row[0]
-        entries_with_photos.add(taxon_id)
-    return entries_with_photos
-
-def get_entry_ancestors(cursor, photo_taxonomy):
-    taxonomy_ids = set(photo_taxonomy)
-    taxonomy_stack = list(photo_taxonomy)
-
-    while taxonomy_stack:
-        taxon_id = taxonomy_stack.pop()
-        cursor.execute(
-            "SELECT parent_id FROM taxons WHERE taxon_id = ?",
-            (taxon_id,)
-        )
-        row = cursor.fetchone()
-        if row[0] not in taxonomy_ids:
-            parent_id = row[0]
-            if parent_id != '':
-                taxonomy_ids.add(parent_id)
-                taxonomy_stack.append(parent_id)
-
-    return taxonomy_ids
-
-def build_taxon_tree(taxonomy_cursor, taxonomy_to_render, entries_with_photos):
-
-    if not taxonomy_to_render:
-        return []
-
-    placeholder_for_taxonomy = ','.join('?' for _ in taxonomy_to_render)
-    taxonomy_cursor.execute(f'''SELECT taxon_id, taxon_name, taxon_rank, parent_id
-                                FROM taxons
-                                WHERE taxon_id IN ({placeholder_for_taxonomy})
-                             ''', tuple(taxonomy_to_render))
-
-    taxonomy_rows = taxonomy_cursor.fetchall()
-    nodes_id = {}
-    children = {}
-
-    for taxon_id, taxon_name, taxon_rank, parent_id in taxonomy_rows:
-            nodes_id[taxon_id] = {
-                "id": taxon_id,
-                "taxon_name": taxon_name,
-                "taxon_rank": taxon_rank,
-                "has_photos": taxon_id in entries_with_photos,
-                "children": []
-            }
-            if parent_id in taxonomy_to_render:
-                children.setdefault(parent_id, []).append(taxon_id)
-    for parent_id, child_ids in children.items():
-        for child_id in child_ids:
-            nodes_id[parent_id]["children"].append(nodes_id[child_id])
-
-    roots = [
-        node for taxon_id, node in nodes_id.items()
-        if next((r[3] for r in taxonomy_rows if r[0] == taxon_id), None) not in taxonomy_to_render
-    ]
-    return roots
-
-def generate_phylogenetic_tree(photo_database_path, taxonomy_database_path):
-    taxonomy_connect = sqlite3.connect(taxonomy_database_path)
-    photos_connect = sqlite3.connect(photo_database_path)
-
-    taxonomy_cursor = taxonomy_connect.cursor()
-    photos_cursor = photos_connect.cursor()
-
-    taxonomy_cursor.execute("PRAGMA foreign_keys = ON;")
-    photos_cursor.execute("PRAGMA foreign_keys = ON;")
-
-    entries_with_photos = get_entries_with_photos(photos_cursor)
-    taxonomy_to_render = get_entry_ancestors(taxonomy_cursor, entries_with_photos)
-
-    tree_data = build_taxon_tree(taxonomy_cursor, taxonomy_to_render, entries_with_photos)
-
-    taxonomy_cursor.close()
-    photos_cursor.close()
-
-    tree_window = PhylogeneticTree(tree_data, photo_database_path) # errors
-    return tree_window
-
-class ImageLabel(QLabel):
-    def __init__(self, pixmap: QPixmap):
+
+@contextmanager
+def cancellable(connection, cancel_event):
+    # Long statements poll the cancel flag while they run; a set flag aborts them as "interrupted"
+    if cancel_event is None:
+        yield
+        return
+    connection.set_progress_handler(cancel_event.is_set, cancel_check_interval)
+    try:
+        yield
+    finally:
+        connection.set_progress_handler(None, cancel_check_interval)
+
+def get_tree_cache_key(photos_cursor, taxonomy_cursor, collapse_rank, tree_metrics):
+    # Everything the cached tree and layout depend on: the photos, the taxonomy, and the font and
+    # spacing. The width of a probe string catches a substituted font or a different screen.
+    return {
+        "photos": get_photo_database_version(photos_cursor),
+        "taxonomy": get_taxonomy_stamp(taxonomy_cursor),
+        "collapse_rank": collapse_rank,
+        "layout": [tree_font_family, tree_font_size, tree_metrics.entry_box_height,
+                   tree_metrics.font_metrics.horizontalAdvance(tree_font_family),
+                   tree_level_height, tree_sibling_spacing],
+    }
+
+def start_tree_load_stage(stage, progress, cancel_event):
+    if cancel_event is not None and cancel_event.is_set():
+        raise TreeLoadCancelled()
+    if progress is not None:
+        progress(tree_load_stages[stage], stage, len(tree_load_stages))
+
+@timed()
+def load_phylogenetic_tree(photo_database_path, taxonomy_database_path, collapse_rank=default_collapse_rank,
+                           progress=None, cancel_event=None, read_only=False):
+    # Queries, tree building and layout; safe to run on a worker thread. progress(stage name, stage, stages)
+    # is called as each stage starts, and setting cancel_event stops the load with TreeLoadCancelled.
+    # An unchanged gallery is read back from its tree cache instead. read_only opens both databases
+    # read-only, so neither file changes: the photo schema isn't migrated, the journal mode stays as it
+    # is and photos whose lineage isn't recorded yet are drawn as roots.
+    cache_path = get_tree_cache_path(photo_database_path, collapse_rank)
+    if read_only:
+        taxonomy_connection = open_read_only(taxonomy_database_path)
+        photos_connection = open_read_only(photo_database_path)
+    else:
+        photo_database = open_photo_database(photo_database_path)
+        taxonomy_connection = get_database(taxonomy_database_path).reader()
+        photos_connection = photo_database.reader()
+
+    try:
+        # Photos added without their lineage (older databases) get it now, so the subtree counts are complete
+        start_tree_load_stage(0, progress, cancel_event)
+        if not read_only:
+            with photo_database.transaction() as connection, cancellable(connection, cancel_event):
+                record_photo_taxa(connection, taxonomy_database_path)
+
+        with cancellable(taxonomy_connection, cancel_event), cancellable(photos_connection, cancel_event):
+            taxonomy_cursor = taxonomy_connection.cursor()
+            photos_cursor = photos_connection.cursor()
+
+            start_tree_load_stage(1, progress, cancel_event)
+            # Key read before the photos, so a photo added meanwhile makes the cache stale rather than wrong
+            tree_metrics = TreeMetrics()
+            # A database read without migrating may have no version to key the cache on
+            cache_key = None
+            if table_exists(photos_cursor, "photo_database_version"):
+                cache_key = get_tree_cache_key(photos_cursor, taxonomy_cursor, collapse_rank, tree_metrics)
+                cached_tree = read_tree_cache(cache_path, cache_key)
+                if cached_tree is not None:
+                    count("tree_cache_hits")
+                    tree_data, collapsed_nodes, layout_nodes, tree_metrics.label_widths = cached_tree
+                    return LoadedTree(tree_data, collapsed_nodes, tree_metrics, layout_nodes)
+
+            # A tree built while lineages are missing is incomplete and isn't cached
+            if table_exists(photos_cursor, "taxon_photo_counts"):
+                lineage_complete = photos_cursor.execute(
+                    "SELECT 1 FROM taxon_photo_counts WHERE parent_id IS NULL LIMIT 1").fetchone() is None
+                entries_with_photos = get_entries_with_photos(photos_cursor)
+                photo_counts = get_photo_counts(photos_cursor)
+            else:
+                lineage_complete = False
+                photo_counts = get_direct_photo_counts(photos_cursor)
+                entries_with_photos = set(photo_counts)
+
+            start_tree_load_stage(2, progress, cancel_event)
+            taxonomy_to_render = get_entry_ancestors(taxonomy_cursor, entries_with_photos)
+
+            start_tree_load_stage(3, progress, cancel_event)
+            tree_data = build_taxon_tree(taxonomy_cursor, taxonomy_to_render, entries_with_photos, photo_counts)
+
+            taxonomy_cursor.close()
+            photos_cursor.close()
+    except sqlite3.OperationalError as error:
+        if cancel_event is not None and cancel_event.is_set():
+            raise TreeLoadCancelled() from error
+        raise
+    finally:
+        if read_only:
+            taxonomy_connection.close()
+            photos_connection.close()
+
+    start_tree_load_stage(4, progress, cancel_event)
+    collapsed_nodes = get_collapsed_nodes(tree_data, collapse_rank)
+    layout_nodes = lay_out_taxon_tree(tree_data, collapsed_nodes, tree_metrics)
+
+    if lineage_complete and cache_key is not None:
+        try:
+            write_tree_cache(cache_path, cache_key, tree_data, collapsed_nodes, layout_nodes,
+                             tree_metrics.label_widths)
+        except OSError:
+            # Only costs the next load its shortcut
+            pass
+
+    return LoadedTree(tree_data, collapsed_nodes, tree_metrics, layout_nodes)
+
+class TreeLoaderSignals(QObject):
+    progress = pyqtSignal(str, int, int)
+    loaded = pyqtSignal(object)
+    cancelled = pyqtSignal()
+    failed = pyqtSignal(str)
+
+class TreeLoader(QRunnable):
+    # Loads the tree view's data on the thread pool; only the scene is built back on the GUI thread
+    def __init__(self, photo_database_path, taxonomy_database_path):
+        super().__init__()
+        self.photo_database_path = photo_database_path
+        self.taxonomy_database_path = taxonomy_database_path
+        self.signals = TreeLoaderSignals()
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def run(self):
+        try:
+            loaded_tree = load_phylogenetic_tree(
+                self.photo_database_path, self.taxonomy_database_path,
+                progress=self.signals.progress.emit, cancel_event=self.cancel_event
+            )
+        except TreeLoadCancelled:
+            self.signals.cancelled.emit()
+        except Exception as error:
+            # An exception escaping a QRunnable takes the whole app down, and the menu would wait forever
+            self.signals.failed.emit(str(error) or type(error).__name__)
+        else:
+            self.signals.loaded.emit(loaded_tree)
+        finally:
+            # Pool threads expire after idling; their connections shouldn't outlive this task
+            get_database(self.photo_database_path).release_reader()
+            get_database(self.taxonomy_database_path).release_reader()
+
+class ThumbnailSignals(QObject):
+    loaded = pyqtSignal(int, int, QImage)
+
+class ThumbnailLoader(QRunnable):
+    def __init__(self, thumbnail_cache, signals, cancel_event, index, photo_path, content_hash, thumbnail_size):
         super().__init__()
-        self.original_pixmap = pixmap
+        self.thumbnail_cache = thumbnail_cache
+        self.signals = signals
+        self.cancel_event = cancel_event
+        self.index = index
+        self.photo_path = photo_path
+        self.content_hash = content_hash
+        self.thumbnail_size = thumbnail_size
+
+    def run(self):
+        if self.cancel_event.is_set():
+            return
+        image = self.thumbnail_cache.get_thumbnail(self.photo_path, self.thumbnail_size, self.content_hash)
+        if not self.cancel_event.is_set():
+            self.signals.loaded.emit(self.index, self.thumbnail_size, image)
+
+class FullSizeImageWindow(QScrollArea):
+    def __init__(self, photo_path):
+        super().__init__()
+        self.setWindowTitle(os.path.basename(photo_path))
+        self.resize(1200, 800)
 
+        # The original is only decoded here, when a photo is opened full size
+        reader = QImageReader(photo_path)
+        reader.setAutoTransform(True)
+        photo_label = QLabel()
+        with span("decode_full_size_photo"):
+            photo_label.setPixmap(QPixmap.fromImage(reader.read()))
+        count("full_size_decodes")
+        self.setWidget(photo_label)
         self.setAlignment(Qt.AlignmentFlag.AlignCenter)
-        self.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Expanding)
 
-    def resizeEvent(self, event):
-        if not self.original_pixmap.isNull():
-            self.setPixmap(self.original_pixmap.scaled(self.size(), Qt.AspectRatioMode.KeepAspectRatio,
-                                            Qt.TransformationMode.SmoothTransformation))
-        super().resizeEvent(event)
+class PhotoListModel(QAbstractListModel):
+    # Photos of taxon_ids, listed taxon by taxon in the given order. Within a taxon they are sorted
+    # by photo_id, or by capture date, and can be limited to one camera; both are done in SQL.
+    def __init__(self, photo_database_path, taxon_ids, thumbnail_cache, thumbnail_size=256,
+                 sort_by_capture_date=False, camera=None):
+        super().__init__()
+        self.photo_database_path = photo_database_path
+        self.taxon_ids = taxon_ids
+        self.thumbnail_cache = thumbnail_cache
+        self.thumbnail_size = thumbnail_size
+        self.sort_by_capture_date = sort_by_capture_date
+        self.camera = camera
+
+        self.page_size = 200
+        self.max_cached_pixmaps = 500
+
+        self.photo_connection = open_photo_database(photo_database_path).reader()
+        # (photo_id, filepath, content_hash, width, height, orientation, captured_at), filled a page at a time
+        self.photo_rows = []
+        self.taxon_index = 0
+        self.last_photo_id = 0
+        self.last_captured_at = ""
+        self.has_more_rows = bool(taxon_ids)
+
+        # row -> QPixmap, least recently shown first
+        self.pixmaps = OrderedDict()
+        self.requested_rows = set()
+
+        # Placeholders by size, shaped like the photo they stand in for
+        self.placeholders = {}
+
+        # Thumbnails are decoded on a worker pool and handed back through a queued signal
+        self.thread_pool = QThreadPool()
+        self.cancel_event = threading.Event()
+        self.thumbnail_signals = ThumbnailSignals()
+        self.thumbnail_signals.loaded.connect(self.thumbnail_loaded)
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.photo_rows)
+
+    def canFetchMore(self, parent):
+        return not parent.isValid() and self.has_more_rows
+
+    @timed("fetch_photo_page")
+    def fetchMore(self, parent):
+        if parent.isValid():
+            return
+        # Keyset pagination on (taxon, sort key, photo_id), so later pages cost the same as the first one
+        rows = []
+        while len(rows) < self.page_size and self.taxon_index < len(self.taxon_ids):
+            wanted = self.page_size - len(rows)
+            taxon_rows = self.query_photo_page(self.taxon_ids[self.taxon_index], wanted)
+            rows.extend(taxon_rows)
+            if len(taxon_rows) < wanted:
+                self.taxon_index += 1
+                self.last_photo_id = 0
+                self.last_captured_at = ""
+            else:
+                self.last_photo_id = taxon_rows[-1][0]
+                self.last_captured_at = taxon_rows[-1][6]
+        self.has_more_rows = self.taxon_index < len(self.taxon_ids)
+        if not rows:
+            return
+        self.beginInsertRows(QModelIndex(), len(self.photo_rows), len(self.photo_rows) + len(rows) - 1)
+        self.photo_rows.extend(rows)
+        self.endInsertRows()
+
+    def query_photo_page(self, taxon_id, limit):
+        # Photos without metadata sort before dated ones, with an empty capture date
+        conditions = ["photos.taxon_id = ?"]
+        parameters = [taxon_id]
+        if self.sort_by_capture_date:
+            conditions.append("(COALESCE(photo_metadata.captured_at, ''), photos.photo_id) > (?, ?)")
+            parameters += [self.last_captured_at, self.last_photo_id]
+            order = "COALESCE(photo_metadata.captured_at, ''), photos.photo_id"
+        else:
+            conditions.append("photos.photo_id > ?")
+            parameters.append(self.last_photo_id)
+            order = "photos.photo_id"
+        if self.camera is not None:
+            conditions.append("photo_metadata.camera = ?")
+            parameters.append(self.camera)
+        parameters.append(limit)
+
+        return self.photo_connection.execute(
+            f'''SELECT photos.photo_id, photos.filepath, photos.content_hash, photo_metadata.width,
+                       photo_metadata.height, photo_metadata.orientation, COALESCE(photo_metadata.captured_at, '')
+                FROM photos
+                LEFT JOIN photo_metadata ON photo_metadata.content_hash = photos.content_hash
+                WHERE {" AND ".join(conditions)}
+                ORDER BY {order} LIMIT ?''',
+            parameters
+        ).fetchall()
+
+    def get_placeholder(self, width, height, orientation):
+        # Gray box with the photo's aspect ratio, known from its metadata before anything is decoded
+        size = self.thumbnail_size
+        if width and height:
+            # EXIF orientations 5-8 are rotated a quarter turn
+            if orientation is not None and orientation >= 5:
+                width, height = height, width
+            if width >= height:
+                size = QSize(self.thumbnail_size, max(1, round(self.thumbnail_size * height / width)))
+            else:
+                size = QSize(max(1, round(self.thumbnail_size * width / height)), self.thumbnail_size)
+        else:
+            size = QSize(size, size)
+
+        key = (size.width(), size.height())
+        placeholder = self.placeholders.get(key)
+        if placeholder is None:
+            placeholder = QPixmap(size)
+            placeholder.fill(Qt.GlobalColor.lightGray)
+            self.placeholders[key] = placeholder
+        return placeholder
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        row = index.row()
+        _, photo_path, _, width, height, orientation, captured_at = self.photo_rows[row]
+
+        if role == Qt.ItemDataRole.DecorationRole:
+            # The view only asks for visible rows, so only those get decoded
+            pixmap = self.pixmaps.get(row)
+            if pixmap is not None:
+                self.pixmaps.move_to_end(row)
+                return pixmap
+            self.request_thumbnail(row)
+            return self.get_placeholder(width, height, orientation)
+        if role == Qt.ItemDataRole.ToolTipRole:
+            return f"{photo_path}\nTaken {captured_at}" if captured_at else photo_path
+        return None
+
+    def get_photo_path(self, row):
+        return self.photo_rows[row][1]
+
+    def get_photo_id(self, row):
+        return self.photo_rows[row][0]
+
+    def request_thumbnail(self, row):
+        if row in self.requested_rows:
+            return
+        self.requested_rows.add(row)
+        self.thread_pool.start(ThumbnailLoader(
+            self.thumbnail_cache, self.thumbnail_signals, self.cancel_event,
+            row, self.photo_rows[row][1], self.photo_rows[row][2], self.thumbnail_size
+        ))
+
+    def thumbnail_loaded(self, row, thumbnail_size, image):
+        self.requested_rows.discard(row)
+        if image.isNull():
+            return
+        self.pixmaps[row] = QPixmap.fromImage(image)
+        count("pixmaps_created")
+        # Rows that fell out of the budget are decoded again from the cache if they scroll back in
+        while len(self.pixmaps) > self.max_cached_pixmaps:
+            self.pixmaps.popitem(last=False)
+        model_index = self.index(row)
+        self.dataChanged.emit(model_index, model_index, [Qt.ItemDataRole.DecorationRole])
+
+    def close(self):
+        # Drops queued decodes; running ones see the event and skip emitting
+        self.cancel_event.set()
+        self.thread_pool.clear()
 
 class ImageGridWindow(QWidget):
-    def __init__(self, taxon_id, taxon_name, photo_database_path):
+    # (photo database path, photo id) of a photo the user chose to remove
+    photo_remove_requested = pyqtSignal(str, int)
+
+    def __init__(self, taxon_ids, title, photo_database_path):
         super().__init__()
-        self.setWindowTitle(f"{taxon_name}")
+        self.setWindowTitle(title)
         self.resize(800, 600)
 
         self.photo_database_path = photo_database_path
-        self.taxon_name = taxon_name
+        self.taxon_ids = taxon_ids
+        self.thumbnail_cache = get_thumbnail_cache(get_thumbnail_cache_dir(photo_database_path))
+        self.photo_model = None
+
+        # Sort and camera filter, both answered from the photo metadata table
+        self.sort_box = QComboBox()
+        self.sort_box.addItems(["Date added", "Date taken"])
+        self.camera_box = QComboBox()
+        self.camera_box.addItem("All cameras", None)
+        for camera in get_cameras(open_photo_database(photo_database_path).reader().cursor(), taxon_ids):
+            self.camera_box.addItem(camera, camera)
+        self.sort_box.currentIndexChanged.connect(self.reload_photos)
+        self.camera_box.currentIndexChanged.connect(self.reload_photos)
+
+        # Icon-mode list view: only items in the viewport are laid out, painted and decoded
+        self.photo_view = QListView()
+        self.photo_view.setViewMode(QListView.ViewMode.IconMode)
+        self.photo_view.setResizeMode(QListView.ResizeMode.Adjust)
+        self.photo_view.setMovement(QListView.Movement.Static)
+        self.photo_view.setUniformItemSizes(True)
+        self.photo_view.setSpacing(6)
+        self.photo_view.activated.connect(self.open_photo)
+        self.photo_view.setContextMenuPolicy(Qt.ContextMenuPolicy.CustomContextMenu)
+        self.photo_view.customContextMenuRequested.connect(self.show_photo_menu)
+        self.reload_photos()
+
+        options_layout = QHBoxLayout()
+        options_layout.addWidget(self.sort_box)
+        options_layout.addWidget(self.camera_box)
+        options_layout.addStretch()
+
+        layout = QVBoxLayout()
+        layout.addLayout(options_layout)
+        layout.addWidget(self.photo_view)
+        self.setLayout(layout)
+
+    def reload_photos(self):
+        # A fresh model per ordering, so thumbnails still decoding for the old rows can't land on new ones
+        if self.photo_model is not None:
+            self.photo_model.close()
+        self.photo_model = PhotoListModel(
+            self.photo_database_path, self.taxon_ids, self.thumbnail_cache,
+            sort_by_capture_date=self.sort_box.currentIndex() == 1, camera=self.camera_box.currentData()
+        )
+        self.photo_view.setIconSize(QSize(self.photo_model.thumbnail_size, self.photo_model.thumbnail_size))
+        self.photo_view.setModel(self.photo_model)
+
+    def open_photo(self, index):
+        self.photo_window = FullSizeImageWindow(self.photo_model.get_photo_path(index.row()))
+        self.photo_window.show()
+
+    def show_photo_menu(self, position):
+        index = self.photo_view.indexAt(position)
+        if not index.isValid():
+            return
+        menu = QMenu(self)
+        remove_action = menu.addAction("Remove Photo")
+        if menu.exec(self.photo_view.viewport().mapToGlobal(position)) is not remove_action:
+            return
+        file_name = os.path.basename(self.photo_model.get_photo_path(index.row()))
+        answer = QMessageBox.question(self, "Remove Photo", f"Remove {file_name} from the gallery?")
+        if answer == QMessageBox.StandardButton.Yes:
+            self.photo_remove_requested.emit(self.photo_database_path, self.photo_model.get_photo_id(index.row()))
+
+    def photo_removed(self):
+        # Rows are addressed by position, so the list is read again rather than patched
+        self.reload_photos()
+
+    def closeEvent(self, event):
+        self.photo_model.close()
+        super().closeEvent(event)
+
+class TaxonNodeItem(QGraphicsRectItem):
+    # Box and label drawn by one item; the label is skipped when zoomed out too far to read
+    def __init__(self, label, font, x, y, width, height):
+        super().__init__(x, y, width, height)
+        self.label = label
+        self.font = font
+
+    def paint(self, painter, option, widget=None):
+        super().paint(painter, option, widget)
+        if option.levelOfDetailFromTransform(painter.worldTransform()) < text_level_of_detail:
+            return
+        painter.setFont(self.font)
+        painter.setPen(Qt.GlobalColor.black)
+        painter.drawText(self.rect(), Qt.AlignmentFlag.AlignCenter, self.label)
+
+class InteractableQGraphicsRectItem(TaxonNodeItem):
+    def __init__(self, tree_window, taxon_id, label, font, x, y, text_width, text_height):
+        super().__init__(label, font, x, y, text_width, text_height)
+        self.tree_window = tree_window
         self.taxon_id = taxon_id
+        self.setAcceptHoverEvents(True)
+        self.setCursor(Qt.CursorShape.PointingHandCursor)
 
-        self.grid_layout = QGridLayout()
-        self.setLayout(self.grid_layout)
-
-        photo_connection = sqlite3.connect(photo_database_path)
-        photo_cursor = photo_connection.cursor()
-
-        self.photo_path_list = [row[0] for row in photo_cursor.execute(
-            'SELECT filepath FROM photos WHERE taxon_id = ?', (self.taxon_id,)).fetchall()]
-        photo_connection.close()
-
-        image_columns = 3
-        for index, photo_path in enumerate(self.photo_path_list):
-            image_row = index // image_columns
-            image_column = index % image_columns
-
-            pixmap = QPixmap(photo_path)
-            label = ImageLabel(pixmap)
-            self.grid_layout.addWidget(label, image_row, image_column)
+    def mousePressEvent(self, event):
+        self.tree_window.open_album(self.taxon_id)
+        super().mousePressEvent(event)
 
-class InteractableQGraphicsRectItem(QGraphicsRectItem):
-    def __init__(self, taxon_id, taxon_name, photo_database_path, x, y, text_width, text_height):
-        super().__init__(x, y, text_width, text_height)
-        self.taxon_name = taxon_name
+class ExpanderItem(TaxonNodeItem):
+    def __init__(self, tree_window, taxon_id, collapsed, font, x, y, size):
+        super().__init__("+" if collapsed else "-", font, x, y, size, size)
+        self.tree_window = tree_window
         self.taxon_id = taxon_id
-        self.photo_database_path = photo_database_path
-        self.setAcceptHoverEvents(True)
         self.setCursor(Qt.CursorShape.PointingHandCursor)
 
     def mousePressEvent(self, event):
-        self.album_window = ImageGridWindow(self.taxon_id, self.taxon_name, self.photo_database_path)
-        self.album_window.show()
-        super().mousePressEvent(event)
+        # Deferred, since toggling rebuilds the scene this item lives in
+        QTimer.singleShot(0, lambda: self.tree_window.toggle_node(self.taxon_id))
+        event.accept()
+
+class TreeGraphicsView(QGraphicsView):
+    visible_area_changed = pyqtSignal()
+
+    def __init__(self, scene):
+        super().__init__(scene)
+        self.setDragMode(QGraphicsView.DragMode.ScrollHandDrag)
+        self.setTransformationAnchor(QGraphicsView.ViewportAnchor.AnchorUnderMouse)
+        self.setViewportUpdateMode(QGraphicsView.ViewportUpdateMode.SmartViewportUpdate)
+        self.setCacheMode(QGraphicsView.CacheModeFlag.CacheBackground)
+        self.setOptimizationFlag(QGraphicsView.OptimizationFlag.DontSavePainterState, True)
+        self.setOptimizationFlag(QGraphicsView.OptimizationFlag.DontAdjustForAntialiasing, True)
+
+    def wheelEvent(self, event):
+        zoom = 1.15 if event.angleDelta().y() > 0 else 1 / 1.15
+        self.scale(zoom, zoom)
+        self.visible_area_changed.emit()
+
+    def scrollContentsBy(self, dx, dy):
+        super().scrollContentsBy(dx, dy)
+        self.visible_area_changed.emit()
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.visible_area_changed.emit()
 
 class PhylogeneticTree(QMainWindow):
-    def __init__(self, tree_data, photo_database_path):
+    # Passed on from the album windows, for the main window to carry out
+    photo_remove_requested = pyqtSignal(str, int)
+
+    # collapsed_nodes, tree_metrics and layout_nodes come from load_phylogenetic_tree when the window
+    # is opened from a background load; without them the initial layout is computed here
+    def __init__(self, tree_data, photo_database_path, taxonomy_database_path,
+                 collapse_rank=default_collapse_rank, collapsed_nodes=None, tree_metrics=None, layout_nodes=None):
         super().__init__()
         self.setWindowTitle("Phylogenetic Tree")
         self.resize(1200, 800)
 
         self.photo_database_path = photo_database_path
+        self.taxonomy_database_path = taxonomy_database_path
+        self.tree_data = tree_data
 
-        self.scene = QGraphicsScene()
-        self.view = QGraphicsView(self.scene)
-        self.view.scale(0.85,0.85)
-        self.setCentralWidget(self.view)
-
-        self.phylogenetic_tree_entry_height_spacing = 75
-        self.entry_box_width = 100
-        self.entry_box_height = 60
-        self.phylogenetic_tree_width_spacing = 50
-
-        self.draw_tree(tree_data, 0, self.phylogenetic_tree_width_spacing)
+        # Album windows by taxon id, kept here since node items come and go with the layout
+        self.album_windows = {}
 
-    def draw_tree(self, nodes, depth, x_start=0):
-        if not nodes:
-            return []
+        # Lookups kept up to date as photos are added and removed
+        self.nodes_by_id = {}
+        self.parent_by_id = {}
+        self.register_nodes(tree_data, None)
 
-        positions = []
-        x = x_start
+        # Subtrees at or below collapse_rank start folded and are expanded on click
+        self.collapse_rank = collapse_rank
+        if collapsed_nodes is None:
+            collapsed_nodes = get_collapsed_nodes(tree_data, collapse_rank)
+        self.collapsed_nodes = collapsed_nodes
 
-        for node in nodes:
-            child_positions = self.draw_tree(node['children'], depth + 1, x)
+        # Heat map scale, fixed when the window opens so a new photo only recolors its own lineage
+        self.max_photo_count = max((node.subtree_photo_count for node in tree_data), default=1)
 
-            # Calculate width
-            if child_positions:
-                subtree_left = min(cx for cx, _ in child_positions)
-                subtree_right = max(cx for cx, _ in child_positions)
-                x_center = (subtree_left + subtree_right) / 2
-            else:
-                label = f"{node['taxon_rank']}: {node['taxon_name']}"
-                font = QFont("Arial", 10)
-                metrics = QFontMetrics(font)
-                text_width = metrics.horizontalAdvance(label) + 10
-                x_center = x + text_width / 2
-
-            y = depth * self.phylogenetic_tree_entry_height_spacing
-
-            # Box
-            label = f"{node['taxon_rank']}: {node['taxon_name']}"
-            font = QFont("Arial", 10)
-            metrics = QFontMetrics(font)
-            text_width = metrics.horizontalAdvance(label) + 20
-            text_height = metrics.height() + 10
-
-            if node['has_photos']:
-                node_box = InteractableQGraphicsRectItem(
-                    node['id'], node['taxon_name'], self.photo_database_path,
-                    x_center - text_width / 2, y, text_width, text_height
-                )
-                node_box.setBrush(Qt.GlobalColor.red)
-            else:
-                node_box = QGraphicsRectItem(
-                    x_center - text_width / 2, y, text_width, text_height
-                )
-                node_box.setBrush(Qt.GlobalColor.lightGray)
-            node_box.setPen(Qt.GlobalColor.black)
-            self.scene.addItem(node_box)
-            node_box.setZValue(1)
-
-            # Text
-            text_item = QGraphicsTextItem(label)
-            text_item.setFont(font)
-            text_item.setDefaultTextColor(Qt.GlobalColor.black)
-            text_item.setPos(x_center - text_width / 2 + 5, y)
-            self.scene.addItem(text_item)
-            text_item.setZValue(2)
-
-            # the lines!
-            for cx, cy in child_positions:
-                line = QGraphicsLineItem(
-                    x_center, y + text_height,  # bottom of parent
-                    cx, cy  # top of child
-                )
-                line.setZValue(0)
-                self.scene.addItem(line)
-
-            if child_positions:
-                x = max(cx + text_width / 2 + self.phylogenetic_tree_width_spacing for cx, _ in child_positions)
-                self.phylogenetic_tree_width_spacing += 10
-            else:
-                x += text_width + self.phylogenetic_tree_width_spacing
-
-            positions.append((x_center, y + text_height))
+        self.scene = QGraphicsScene()
+        self.view = TreeGraphicsView(self.scene)
+        self.view.scale(0.85,0.85)
+        self.view.visible_area_changed.connect(self.populate_visible_items)
+        self.setCentralWidget(self.view)
 
-        return positions
+        # One font and metrics object for the whole tree; label widths are measured once per label
+        self.tree_metrics = tree_metrics if tree_metrics is not None else TreeMetrics()
+        self.font = self.tree_metrics.font
+
+        self.draw_tree(tree_data, layout_nodes)
+
+    @timed()
+    def draw_tree(self, nodes, layout_nodes=None):
+        self.scene.clear()
+        self.node_items = {}
+        self.node_placements = {}
+        self.update_layout(nodes, layout_nodes=layout_nodes)
+
+    @timed()
+    def update_layout(self, nodes, changed_ids=(), layout_nodes=None):
+        if layout_nodes is None:
+            layout_nodes = lay_out_taxon_tree(nodes, self.collapsed_nodes, self.tree_metrics)
+        self.layout_nodes = layout_nodes
+        self.layout_by_id = {layout_node.node.id: layout_node for layout_node in self.layout_nodes}
+        self.layout_index = TreeLayoutIndex(self.layout_nodes, tree_level_height)
+
+        # The scene rect covers the whole tree, even though items only exist where the view has been
+        left, top, right, bottom = get_layout_bounds(self.layout_nodes)
+        margin = tree_sibling_spacing
+        self.scene.setSceneRect(QRectF(left - margin, top - margin,
+                                       right - left + 2 * margin, bottom - top + 2 * margin))
+
+        # Existing items are kept unless their node changed, moved or left the layout
+        for taxon_id in list(self.node_items):
+            layout_node = self.layout_by_id.get(taxon_id)
+            if (layout_node is None or taxon_id in changed_ids
+                    or self.node_placements[taxon_id] != self.get_node_placement(layout_node)):
+                self.remove_node_items(taxon_id)
+
+        self.populate_visible_items()
+
+    def get_node_placement(self, layout_node):
+        parent = layout_node.parent
+        parent_center = None if parent is None else parent.x_center
+        return layout_node.x, layout_node.y, parent_center, layout_node.node.id in self.collapsed_nodes
+
+    def remove_node_items(self, taxon_id):
+        for item in self.node_items.pop(taxon_id):
+            self.scene.removeItem(item)
+        del self.node_placements[taxon_id]
+
+    def register_nodes(self, nodes, parent):
+        stack = [(node, parent) for node in nodes]
+        while stack:
+            node, parent = stack.pop()
+            self.nodes_by_id[node.id] = node
+            self.parent_by_id[node.id] = parent
+            stack.extend((child, node) for child in node.children)
+
+    @timed()
+    def populate_visible_items(self):
+        visible_rect = self.view.mapToScene(self.view.viewport().rect()).boundingRect()
+        # Half a screen of margin, so short pans don't uncover empty space
+        margin_x = visible_rect.width() / 2
+        margin_y = visible_rect.height() / 2
+        for layout_node in self.layout_index.query(
+                visible_rect.left() - margin_x, visible_rect.top() - margin_y,
+                visible_rect.right() + margin_x, visible_rect.bottom() + margin_y):
+            if layout_node.node.id not in self.node_items:
+                self.draw_node(layout_node)
+
+    def toggle_node(self, taxon_id):
+        if taxon_id in self.collapsed_nodes:
+            self.collapsed_nodes.remove(taxon_id)
+        else:
+            self.collapsed_nodes.add(taxon_id)
+        self.update_layout(self.tree_data, (taxon_id,))
+        layout_node = self.layout_by_id[taxon_id]
+        self.view.centerOn(layout_node.x_center, layout_node.y)
+
+    def open_album(self, taxon_id):
+        node = self.nodes_by_id[taxon_id]
+        if node.children:
+            # Every photo under an inner node, found with one range scan of the taxonomy's interval numbers
+            taxonomy_cursor = get_database(self.taxonomy_database_path).reader().cursor()
+            photos_cursor = open_photo_database(self.photo_database_path).reader().cursor()
+            taxon_ids = get_subtree_photo_taxa(taxonomy_cursor, photos_cursor, taxon_id)
+            title = f"{node.taxon_name} ({node.subtree_photo_count} photos in subtree)"
+        else:
+            taxon_ids = [taxon_id]
+            title = node.taxon_name
+        album_window = ImageGridWindow(taxon_ids, title, self.photo_database_path)
+        album_window.photo_remove_requested.connect(self.photo_remove_requested)
+        self.album_windows[taxon_id] = album_window
+        album_window.show()
+
+    def get_lineage_ids(self, taxon_id):
+        lineage_ids = []
+        node = self.nodes_by_id.get(taxon_id)
+        while node is not None:
+            lineage_ids.append(node.id)
+            node = self.parent_by_id[node.id]
+        return lineage_ids
+
+    def refresh_photo_counts(self, taxon_ids):
+        # Reread from the counts table, which the photo database keeps current
+        photo_counts = get_photo_counts(open_photo_database(self.photo_database_path).reader().cursor(), taxon_ids)
+        for taxon_id in taxon_ids:
+            node = self.nodes_by_id[taxon_id]
+            node.photo_count, node.subtree_photo_count = photo_counts.get(taxon_id, (0, 0))
+            node.has_photos = node.photo_count > 0
+
+    def photo_added(self, photo_database_path, taxon_id):
+        if photo_database_path != self.photo_database_path:
+            return
+
+        if taxon_id in self.nodes_by_id:
+            lineage_ids = self.get_lineage_ids(taxon_id)
+            self.refresh_photo_counts(lineage_ids)
+            self.update_layout(self.tree_data, lineage_ids)
+            return
+
+        # Fetch just the new lineage and graft it under the deepest node already in the tree
+        taxonomy_cursor = get_database(self.taxonomy_database_path).reader().cursor()
+        lineage_ids = get_entry_ancestors(taxonomy_cursor, {taxon_id})
+        lineage = build_taxon_tree(taxonomy_cursor, lineage_ids, {taxon_id})
+        if not lineage:
+            return
+
+        parent = None
+        branch = lineage[0]
+        while branch.id in self.nodes_by_id:
+            parent = self.nodes_by_id[branch.id]
+            if not branch.children:
+                return
+            branch = branch.children[0]
+
+        siblings = self.tree_data if parent is None else parent.children
+        # Children are kept in taxon id order, as build_taxon_tree returns them
+        insert_at = next((index for index, sibling in enumerate(siblings) if sibling.id > branch.id), len(siblings))
+        siblings.insert(insert_at, branch)
+        self.register_nodes([branch], parent)
+        self.collapsed_nodes |= get_collapsed_nodes([branch], self.collapse_rank)
+
+        # Every node on the lineage shows a new count
+        lineage_ids = self.get_lineage_ids(taxon_id)
+        self.refresh_photo_counts(lineage_ids)
+        self.update_layout(self.tree_data, lineage_ids)
+
+    def photo_removed(self, photo_database_path, taxon_id):
+        if photo_database_path != self.photo_database_path:
+            return
+        # Any open album may have listed the photo
+        for album_window in self.album_windows.values():
+            if album_window.isVisible():
+                album_window.photo_removed()
+
+        node = self.nodes_by_id.get(taxon_id)
+        if node is None or not node.has_photos:
+            return
+
+        changed_ids = self.get_lineage_ids(taxon_id)
+        self.refresh_photo_counts(changed_ids)
+
+        # Prune the lineage up to the first ancestor that still leads to photos
+        while node is not None and not node.has_photos and not node.children:
+            parent = self.parent_by_id.pop(node.id)
+            del self.nodes_by_id[node.id]
+            self.collapsed_nodes.discard(node.id)
+            siblings = self.tree_data if parent is None else parent.children
+            siblings.remove(node)
+            node = parent
+
+        self.update_layout(self.tree_data, changed_ids)
+
+    def draw_node(self, layout_node):
+        node = layout_node.node
+        label = get_node_label(node)
+        items = []
+
+        # Box, colored by the photos in its subtree; taxa with photos of their own get a heavier outline.
+        # Inner nodes open an album of their whole subtree.
+        if node.has_photos or node.children:
+            node_box = InteractableQGraphicsRectItem(
+                self, node.id, label, self.font,
+                layout_node.x, layout_node.y, layout_node.width, layout_node.height
+            )
+        else:
+            node_box = TaxonNodeItem(
+                label, self.font, layout_node.x, layout_node.y, layout_node.width, layout_node.height
+            )
+        node_box.setPen(QPen(Qt.GlobalColor.black, 2) if node.has_photos else QPen(Qt.GlobalColor.black))
+        node_box.setBrush(get_heat_color(node.subtree_photo_count, self.max_photo_count))
+        self.scene.addItem(node_box)
+        node_box.setZValue(1)
+        items.append(node_box)
+
+        # Expand/collapse toggle to the right of the box
+        if node.children:
+            expander = ExpanderItem(
+                self, node.id, node.id in self.collapsed_nodes, self.font,
+                layout_node.x + layout_node.width + 2,
+                layout_node.y + (layout_node.height - tree_expander_size) / 2,
+                tree_expander_size
+            )
+            expander.setBrush(Qt.GlobalColor.white)
+            expander.setPen(Qt.GlobalColor.black)
+            self.scene.addItem(expander)
+            expander.setZValue(1)
+            items.append(expander)
+
+        # the line up to the parent
+        parent = layout_node.parent
+        if parent is not None:
+            line = QGraphicsLineItem(
+                parent.x_center, parent.y + parent.height,  # bottom of parent
+                layout_node.x_center, layout_node.y  # top of child
+            )
+            line.setZValue(0)
+            self.scene.addItem(line)
+            items.append(line)
+
+        self.node_items[node.id] = items
+        count("scene_items", len(items))
+        self.node_placements[node.id] = self.get_node_placement(layout_node)
+
+class TaxonSearchModel(QAbstractListModel):
+    def __init__(self, taxonomy_database_path):
+        super().__init__()
+        self.taxonomy_connection = get_database(taxonomy_database_path).reader()
+        self.use_index = has_taxon_search_index(self.taxonomy_connection.cursor())
+        self.results = []  # (taxon_id, taxon_name, taxon_rank)
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.results)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        taxon_id, taxon_name, taxon_rank = self.results[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole:
+            # Rank shown alongside, so homonyms can be told apart
+            return f"{taxon_name} [{taxon_rank}]"
+        if role == Qt.ItemDataRole.EditRole:
+            return taxon_name
+        if role == Qt.ItemDataRole.UserRole:
+            return taxon_id
+        return None
+
+    def set_query(self, text):
+        self.beginResetModel()
+        self.results = search_taxons(self.taxonomy_connection.cursor(), text, use_index=self.use_index)
+        self.endResetModel()
+
+    def find_taxon_ids(self, taxon_name):
+        return find_taxon_ids(self.taxonomy_connection.cursor(), taxon_name)
 
 class MainWindow(QMainWindow):
+    # (photo database path, taxon id), so open tree windows can patch themselves
+    photo_added = pyqtSignal(str, int)
+    photo_removed = pyqtSignal(str, int)
 
     def __init__(self):
         super().__init__()
@@ -320,14 +929,13 @@ class MainWindow(QMainWindow):
         self.base_dir = os.path.dirname(os.path.abspath(__file__))
         self.taxonomic_database_path = os.path.join(self.base_dir, 'taxonomy.db')
 
-        taxonomy = sqlite3.connect(self.taxonomic_database_path)
-        taxonomy_cursor = taxonomy.cursor()
-        taxonomy_cursor.execute("""SELECT taxon_id, taxon_name FROM taxons""")
-        taxonomy_rows = taxonomy_cursor.fetchall()
-        self.taxon_name_to_id = {name: taxon_id for taxon_id, name in taxonomy_rows}
-        self.taxonomy_names_list = list(self.taxon_name_to_id.keys())
-
-        taxonomy.close()
+        # Taxon names are searched on demand instead of being loaded up front
+        self.taxon_search_model = TaxonSearchModel(self.taxonomic_database_path)
+        self.selected_taxon_id = None
+        self.taxon_search_timer = QTimer()
+        self.taxon_search_timer.setSingleShot(True)
+        self.taxon_search_timer.setInterval(150)
+        self.taxon_search_timer.timeout.connect(self.update_taxon_search)
 
         # Widgets
         self.database_name_line_edit = QLineEdit()
@@ -335,6 +943,12 @@ class MainWindow(QMainWindow):
         self.database_load_message = QLabel("")
         self.view_database_button = QPushButton("View Database")
         self.add_photo_line_button = QPushButton("Add Photo")
+        self.tree_load_progress = QProgressBar()
+        self.cancel_tree_load_button = QPushButton("Cancel")
+
+        # Tree view being loaded in the background, and photo changes made while it loads
+        self.tree_loader = None
+        self.missed_photo_changes = []
 
         # Pages
         self.page0 = QWidget()
@@ -380,17 +994,17 @@ class MainWindow(QMainWindow):
         new_database_line_edit_button.setFixedWidth(250)
 
         # Upload Photo Line Edit
-        add_photo_edit_button_completer = QCompleter(self.taxonomy_names_list)
-        add_photo_edit_button_completer.setCaseSensitivity(Qt.CaseSensitivity.CaseInsensitive)
-        add_photo_edit_button_completer.setFilterMode(Qt.MatchFlag.MatchContains)
-        add_photo_edit_button_completer.setCompletionMode(QCompleter.CompletionMode.PopupCompletion)
+        # The model already holds the filtered search results, so the completer shows them as they are
+        self.add_photo_edit_button_completer = QCompleter(self.taxon_search_model)
+        self.add_photo_edit_button_completer.setCaseSensitivity(Qt.CaseSensitivity.CaseInsensitive)
+        self.add_photo_edit_button_completer.setCompletionMode(QCompleter.CompletionMode.UnfilteredPopupCompletion)
         self.add_photo_line_button.setSizePolicy(QSizePolicy.Policy.Fixed, QSizePolicy.Policy.Fixed)
         self.add_photo_line_button.setFixedWidth(250)
         self.add_photo_line_button.setEnabled(False)
 
 
         self.add_photo_line_edit.setEnabled(False)
-        self.add_photo_line_edit.setCompleter(add_photo_edit_button_completer)
+        self.add_photo_line_edit.setCompleter(self.add_photo_edit_button_completer)
         self.add_photo_line_edit.setFont(QFont("Arial", 11))
         self.add_photo_line_edit.setPlaceholderText("Enter Name")
         self.add_photo_line_edit.setFixedWidth(250)
@@ -416,10 +1030,20 @@ class MainWindow(QMainWindow):
         self.view_database_button.setSizePolicy(QSizePolicy.Policy.Fixed, QSizePolicy.Policy.Fixed)
         self.view_database_button.setFixedWidth(250)
 
+        # Tree Load Progress, shown while the tree view loads
+        self.tree_load_progress.setFixedWidth(250)
+        self.tree_load_progress.setVisible(False)
+        self.cancel_tree_load_button.setSizePolicy(QSizePolicy.Policy.Fixed, QSizePolicy.Policy.Fixed)
+        self.cancel_tree_load_button.setFixedWidth(250)
+        self.cancel_tree_load_button.setVisible(False)
+
         # Connect
         self.database_name_line_edit.returnPressed.connect(self.load_database)
         self.add_photo_line_edit.returnPressed.connect(self.upload_image_gui)
+        self.add_photo_line_edit.textEdited.connect(self.schedule_taxon_search)
+        self.add_photo_edit_button_completer.activated[QModelIndex].connect(self.select_taxon)
         self.view_database_button.clicked.connect(self.view_database)
+        self.cancel_tree_load_button.clicked.connect(self.cancel_tree_load)
         load_database_line_edit_button.clicked.connect(self.load_database)
         new_database_line_edit_button.clicked.connect(self.new_database)
         self.add_photo_line_button.clicked.connect(self.upload_image_gui)
@@ -439,6 +1063,9 @@ class MainWindow(QMainWindow):
         main_menu_layout.addWidget(new_database_line_edit_button, alignment=Qt.AlignmentFlag.AlignCenter)
         main_menu_layout.addSpacing(2)
         main_menu_layout.addWidget(self.view_database_button, alignment=Qt.AlignmentFlag.AlignCenter)
+        main_menu_layout.addSpacing(2)
+        main_menu_layout.addWidget(self.tree_load_progress, alignment=Qt.AlignmentFlag.AlignCenter)
+        main_menu_layout.addWidget(self.cancel_tree_load_button, alignment=Qt.AlignmentFlag.AlignCenter)
         main_menu_layout.addSpacing(20)
         main_menu_layout.addWidget(self.add_photo_line_edit, alignment=Qt.AlignmentFlag.AlignCenter)
         main_menu_layout.addSpacing(2)
@@ -462,8 +1089,32 @@ class MainWindow(QMainWindow):
             self.database_load_message.setVisible(True)
         self.database_name_line_edit.clear()
 
+    def schedule_taxon_search(self):
+        # Debounced, so typing a name runs one query instead of one per keystroke
+        self.selected_taxon_id = None
+        self.taxon_search_timer.start()
+
+    def update_taxon_search(self):
+        self.taxon_search_model.set_query(self.add_photo_line_edit.text())
+        if self.taxon_search_model.rowCount() > 0:
+            self.add_photo_edit_button_completer.complete()
+
+    def select_taxon(self, index):
+        self.selected_taxon_id = index.data(Qt.ItemDataRole.UserRole)
+
     def upload_image_gui(self):
-        if self.add_photo_line_edit.text() not in self.taxonomy_names_list:
+        taxon_id = self.selected_taxon_id
+        if taxon_id is None:
+            taxon_ids = self.taxon_search_model.find_taxon_ids(self.add_photo_line_edit.text())
+            if len(taxon_ids) == 1:
+                taxon_id = taxon_ids[0]
+            elif len(taxon_ids) > 1:
+                self.database_load_message.setText("Several taxa share this name, pick one from the list")
+                self.database_load_message.setStyleSheet("color: red;")
+                self.database_load_message.setVisible(True)
+                return
+
+        if taxon_id is None:
             self.database_load_message.setText("Taxon not found")
             self.database_load_message.setStyleSheet("color: red;")
             self.database_load_message.setVisible(True)
@@ -471,25 +1122,116 @@ class MainWindow(QMainWindow):
             self.database_load_message.setText("Taxon found")
             self.database_load_message.setStyleSheet("color: green;")
             self.database_load_message.setVisible(True)
-            taxon_name = self.add_photo_line_edit.text()
-            taxon_id = self.taxon_name_to_id.get(taxon_name)
-            upload_image(self.photo_database_name, taxon_id, self.add_photo_line_edit)
+            if upload_image(self.photo_database_name, taxon_id, self.add_photo_line_edit,
+                            self.taxonomic_database_path) is not None:
+                self.photo_added.emit(self.photo_database_path, taxon_id)
+                if self.tree_loader is not None:
+                    self.missed_photo_changes.append((True, self.photo_database_path, taxon_id))
         self.add_photo_line_edit.clear()
+        self.selected_taxon_id = None
 
     def view_database(self):
-        self.tree_window = generate_phylogenetic_tree(self.photo_database_path, self.taxonomic_database_path)
+        # Queries, tree building and layout run on the thread pool; the menu stays responsive meanwhile
+        if self.tree_loader is not None:
+            return
+        self.tree_loader = TreeLoader(self.photo_database_path, self.taxonomic_database_path)
+        self.tree_loader.signals.progress.connect(self.show_tree_load_progress)
+        self.tree_loader.signals.loaded.connect(self.open_tree_window)
+        self.tree_loader.signals.cancelled.connect(self.tree_load_cancelled)
+        self.tree_loader.signals.failed.connect(self.tree_load_failed)
+        self.missed_photo_changes = []
+
+        self.view_database_button.setEnabled(False)
+        self.tree_load_progress.setRange(0, len(tree_load_stages))
+        self.tree_load_progress.setValue(0)
+        self.tree_load_progress.setVisible(True)
+        self.cancel_tree_load_button.setEnabled(True)
+        self.cancel_tree_load_button.setVisible(True)
+        QThreadPool.globalInstance().start(self.tree_loader)
+
+    def show_tree_load_progress(self, stage_name, stage, stages):
+        self.tree_load_progress.setValue(stage)
+        self.tree_load_progress.setFormat(f"{stage_name} ({stage + 1}/{stages})")
+
+    def cancel_tree_load(self):
+        if self.tree_loader is not None:
+            self.tree_loader.cancel()
+            self.cancel_tree_load_button.setEnabled(False)
+
+    def finish_tree_load(self):
+        self.tree_loader = None
+        self.tree_load_progress.setVisible(False)
+        self.cancel_tree_load_button.setVisible(False)
+        self.view_database_button.setEnabled(True)
+
+    def open_tree_window(self, loaded_tree):
+        # Only the scene is built here, from the layout computed on the worker
+        photo_database_path = self.tree_loader.photo_database_path
+        self.finish_tree_load()
+        self.tree_window = PhylogeneticTree(
+            loaded_tree.tree_data, photo_database_path, self.taxonomic_database_path,
+            collapsed_nodes=loaded_tree.collapsed_nodes, tree_metrics=loaded_tree.tree_metrics,
+            layout_nodes=loaded_tree.layout_nodes
+        )
+        self.photo_added.connect(self.tree_window.photo_added)
+        self.photo_removed.connect(self.tree_window.photo_removed)
+        self.tree_window.photo_remove_requested.connect(self.remove_photo)
+
+        # Photos added or removed after the load read its counts; patching is idempotent, so replay them all
+        for added, changed_database_path, taxon_id in self.missed_photo_changes:
+            if added:
+                self.tree_window.photo_added(changed_database_path, taxon_id)
+            else:
+                self.tree_window.photo_removed(changed_database_path, taxon_id)
+        self.missed_photo_changes = []
         self.tree_window.show()
 
+    def tree_load_cancelled(self):
+        self.finish_tree_load()
+        self.database_load_message.setText("Loading cancelled")
+        self.database_load_message.setStyleSheet("color: red;")
+        self.database_load_message.setVisible(True)
+
+    def tree_load_failed(self, error):
+        self.finish_tree_load()
+        self.database_load_message.setText(f"Could not load the tree: {error}")
+        self.database_load_message.setStyleSheet("color: red;")
+        self.database_load_message.setVisible(True)
+
+    def remove_photo(self, photo_database_path, photo_id):
+        # Asked for from an album's context menu
+        taxon_id = delete_photo(photo_database_path, photo_id)
+        if taxon_id is not None:
+            self.photo_removed.emit(photo_database_path, taxon_id)
+            if self.tree_loader is not None:
+                self.missed_photo_changes.append((False, photo_database_path, taxon_id))
+
     def new_database(self):
         if self.database_name_line_edit.text() != "":
             create_photo_database(self.database_name_line_edit.text())
             self.load_database()
 
+    def closeEvent(self, event):
+        # Don't keep the app alive for a tree nobody will see
+        self.cancel_tree_load()
+        super().closeEvent(event)
+
 def main():
-    app = QApplication(sys.argv)
+    parser = argparse.ArgumentParser(description="Arthropod Gallery")
+    parser.add_argument("--profile", action="store_true", help="print timing and SQL stats on exit")
+    parser.add_argument("--trace", metavar="FILE", help="write a Chrome trace-format file on exit")
+    parser.add_argument("--cprofile", metavar="STAGE", action="append", default=[],
+                        help="run a stage (e.g. build_taxon_tree, draw_tree) under cProfile")
+    args, qt_args = parser.parse_known_args()
+    if args.profile or args.trace or args.cprofile:
+        instrumentation.enable(args.trace, args.cprofile)
+
+    app = QApplication(sys.argv[:1] + qt_args)
     window = MainWindow()
     window.show()
-    sys.exit(app.exec())
+    exit_code = app.exec()
+    close_all_databases()
+    sys.exit(exit_code)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,213 @@
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import argparse
+import platform
+import tempfile
+from create_taxonomic_database import import_taxonomy
+from database import get_database, close_all_databases
+from photo_database import open_photo_database, record_photo_taxa
+from taxon_tree import get_entries_with_photos, get_photo_counts, get_entry_ancestors, build_taxon_tree
+from tree_layout import layout_tree, get_node_label
+
+# Ranks of the synthetic taxonomy, one per depth below the root
+synthetic_ranks = ["class", "order", "family", "genus", "species"]
+name_syllables = ["ar", "thro", "po", "da", "lep", "ido", "ptera", "co", "leo", "hem", "ip", "ter",
+                  "ara", "ne", "ae", "myr", "ia", "pod", "cu", "li", "dae", "nus", "ma", "ta"]
+
+default_sizes = [1000, 10000, 100000]
+default_photo_densities = [0.01, 0.1]
+
+def make_synthetic_name(rng, rank):
+    name = "".join(rng.choice(name_syllables) for _ in range(rng.randint(2, 4))).capitalize()
+    if rank == "species":
+        name += " " + "".join(rng.choice(name_syllables) for _ in range(rng.randint(2, 3)))
+    return name
+
+def write_synthetic_dump(dump_path, taxa_count, seed=0):
+    # NCBI-style indented dump of taxa_count lines under one phylum, written depth first.
+    # A few "no rank" and "sp." lines are mixed in so the importer's filters get exercised.
+    rng = random.Random(seed)
+    # The phylum's classes branch too, so each of the ranks below it multiplies the count
+    branching = max(2.0, taxa_count ** (1 / len(synthetic_ranks)))
+    next_taxon_id = 1
+    written = 0
+
+    with open(dump_path, "w") as dump_file:
+        dump_file.write(f"{next_taxon_id} [phylum] Arthropoda\n")
+        next_taxon_id += 1
+        written += 1
+        # (depth of the children to write, children still to write)
+        stack = [(0, max(1, round(branching)))]
+        while written < taxa_count:
+            if not stack:
+                # The random branching fell short; another class makes up the rest
+                stack.append((0, 1))
+            depth, remaining = stack.pop()
+            if remaining == 0:
+                continue
+            stack.append((depth, remaining - 1))
+
+            rank = synthetic_ranks[depth]
+            roll = rng.random()
+            if roll < 0.01:
+                rank_label, name = "no rank", "unclassified " + make_synthetic_name(rng, "genus")
+            elif roll < 0.02 and rank == "species":
+                rank_label, name = rank, make_synthetic_name(rng, "genus") + " sp. " + str(next_taxon_id)
+            else:
+                rank_label, name = rank, make_synthetic_name(rng, rank)
+
+            dump_file.write(f"{'  ' * (depth + 1)}{next_taxon_id} [{rank_label}] {name}\n")
+            next_taxon_id += 1
+            written += 1
+
+            if depth + 1 < len(synthetic_ranks):
+                children = max(1, round(rng.uniform(0.5, 1.5) * branching))
+                stack.append((depth + 1, children))
+    return written
+
+def write_synthetic_photos(photo_database_path, taxonomy_database_path, photo_density, seed=0,
+                           max_photos_per_taxon=5):
+    # Gives photo_density of the species between 1 and max_photos_per_taxon photo rows.
+    # Only rows are written; the benchmarked stages never open the files.
+    rng = random.Random(seed)
+    taxonomy = sqlite3.connect(taxonomy_database_path)
+    species_ids = [row[0] for row in taxonomy.execute("SELECT taxon_id FROM taxons WHERE taxon_rank = 'species'")]
+    taxonomy.close()
+
+    photographed = rng.sample(species_ids, max(1, int(len(species_ids) * photo_density))) if species_ids else []
+    photo_rows = []
+    for taxon_id in photographed:
+        for _ in range(rng.randint(1, max_photos_per_taxon)):
+            content_hash = f"{rng.getrandbits(256):064x}"
+            photo_path = os.path.join("synthetic", content_hash[:2], content_hash[2:4], content_hash + ".jpg")
+            photo_rows.append((taxon_id, photo_path, content_hash, rng.randint(100000, 20000000), 0.0))
+
+    with open_photo_database(photo_database_path).transaction() as connection:
+        record_photo_taxa(connection, taxonomy_database_path, photographed)
+        connection.executemany(
+            "INSERT INTO photos (taxon_id, filepath, content_hash, byte_size, mtime) VALUES (?, ?, ?, ?, ?)",
+            photo_rows
+        )
+    return len(photo_rows)
+
+def count_nodes(roots):
+    count = 0
+    stack = list(roots)
+    while stack:
+        node = stack.pop()
+        count += 1
+        stack.extend(node.children)
+    return count
+
+def get_qt_application():
+    # Offscreen platform, so rendering can be timed on a machine without a display
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    try:
+        from PyQt6.QtWidgets import QApplication
+    except ImportError:
+        return None
+    return QApplication.instance() or QApplication(sys.argv[:1])
+
+def count_taxa(taxonomy_database_path):
+    taxonomy = sqlite3.connect(taxonomy_database_path)
+    taxa_count = taxonomy.execute("SELECT COUNT(*) FROM taxons").fetchone()[0]
+    taxonomy.close()
+    return taxa_count
+
+def time_stage(results, case, stage, function, *args):
+    start_time = time.perf_counter()
+    value = function(*args)
+    elapsed = time.perf_counter() - start_time
+    results.append(dict(case, stage=stage, seconds=elapsed))
+    print(f"{case['taxa']:>9} taxa  {str(case['photo_density']):<6} {stage:<12} {elapsed:9.4f} s")
+    return value
+
+def run_case(work_dir, taxa_count, photo_density, seed, render, results):
+    dump_path = os.path.join(work_dir, f"dump_{taxa_count}.txt")
+    taxonomy_database_path = os.path.join(work_dir, f"taxonomy_{taxa_count}.db")
+    photo_database_path = os.path.join(work_dir, f"photos_{taxa_count}_{photo_density}.db")
+
+    # Results record the taxa actually imported; the filtered dump lines fall a little short of the request
+    if not os.path.exists(taxonomy_database_path):
+        write_synthetic_dump(dump_path, taxa_count, seed)
+        case = {"requested_taxa": taxa_count, "taxa": taxa_count, "photo_density": None, "photos": 0}
+        time_stage(results, case, "import", import_taxonomy, dump_path, taxonomy_database_path)
+        results[-1]["taxa"] = count_taxa(taxonomy_database_path)
+
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(photo_database_path + suffix):
+            os.remove(photo_database_path + suffix)
+    photo_count = write_synthetic_photos(photo_database_path, taxonomy_database_path, photo_density, seed)
+    case = {"requested_taxa": taxa_count, "taxa": count_taxa(taxonomy_database_path),
+            "photo_density": photo_density, "photos": photo_count}
+
+    taxonomy_cursor = get_database(taxonomy_database_path).reader().cursor()
+    photos_cursor = open_photo_database(photo_database_path).reader().cursor()
+
+    entries_with_photos = time_stage(results, case, "photos", get_entries_with_photos, photos_cursor)
+    photo_counts = time_stage(results, case, "counts", get_photo_counts, photos_cursor)
+    taxonomy_to_render = time_stage(results, case, "ancestors", get_entry_ancestors,
+                                    taxonomy_cursor, entries_with_photos)
+    tree_data = time_stage(results, case, "build", build_taxon_tree,
+                           taxonomy_cursor, taxonomy_to_render, entries_with_photos, photo_counts)
+    case["rendered_taxa"] = count_nodes(tree_data)
+
+    # Headless layout with an approximate label width, independent of any font
+    time_stage(results, case, "layout", layout_tree, tree_data,
+               lambda node: len(get_node_label(node)) * 7 + 20, 25)
+
+    if render:
+        application = get_qt_application()
+        if application is None:
+            print("PyQt6 not available, skipping the draw stage")
+        else:
+            from arthropod_gallery import PhylogeneticTree
+            time_stage(results, case, "draw", PhylogeneticTree,
+                       tree_data, photo_database_path, taxonomy_database_path)
+            # Fully expanded tree with every item created, the old worst case
+            tree_window = time_stage(results, case, "draw_full", PhylogeneticTree,
+                                     tree_data, photo_database_path, taxonomy_database_path, None)
+            time_stage(results, case, "draw_all", lambda: [
+                tree_window.draw_node(layout_node) for layout_node in tree_window.layout_nodes
+                if layout_node.node.id not in tree_window.node_items
+            ])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the taxonomy and gallery pipeline on synthetic data")
+    parser.add_argument("--sizes", type=int, nargs="+", default=default_sizes,
+                        help="taxa in each synthetic taxonomy (10^3 to 10^6)")
+    parser.add_argument("--photo-densities", type=float, nargs="+", default=default_photo_densities,
+                        help="fraction of species that get photos")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-render", action="store_true", help="skip the Qt drawing stages")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON file to write results to")
+    parser.add_argument("--work-dir", default=None, help="keep generated data here instead of a temp dir")
+    args = parser.parse_args(argv)
+
+    results = []
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        work_dir = args.work_dir or temporary_dir
+        os.makedirs(work_dir, exist_ok=True)
+        for taxa_count in args.sizes:
+            for photo_density in args.photo_densities:
+                run_case(work_dir, taxa_count, photo_density, args.seed, not args.no_render, results)
+        close_all_databases()
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "seed": args.seed,
+        "results": results,
+    }
+    with open(args.output, "w") as output_file:
+        json.dump(report, output_file, indent=2)
+    print(f"Results written to {args.output}")
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,82 +1,497 @@
 import re
 import sqlite3
 import os
-input_file = "arthropoda_ids.txt"
-
-lines = [line.rstrip("\n") for line in open(input_file)]
-
-parent_id_list = []  # tracks parent IDs per indentation level
-filter_output = []
+import sys
+import gzip
+import mmap
+import time
+import argparse
+from glob import glob
+from array import array
+from taxon_search import (create_taxon_search_index, has_taxon_search_index, delete_taxon_search_entries,
+                          insert_taxon_search_entries)
+from taxon_tree import get_photo_counts, get_taxonomy_version
+from database import close_all_databases
+from photo_database import open_photo_database, forget_taxon_lineage
 
 # regex formula that finds and captures the id, taxon rank, and taxon name
 taxon_regex = re.compile(r'^(\d+)\s+\[([^\]]+)\]\s+(.+)$')
 
-base_dir = os.path.dirname(os.path.abspath(__file__))
-database_path = os.path.join(base_dir, 'taxonomy.db')
-taxonomy = sqlite3.connect(database_path)
-cursor = taxonomy.cursor()
-cursor.execute("PRAGMA foreign_keys = ON;")
-
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS taxons (
-        taxon_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        taxon_rank TEXT NOT NULL,
-        taxon_name TEXT NOT NULL,
-        parent_id INTEGER
-    )
-    ''')
+# Skipping unnecessary or rarely used ranks.
+ignored_ranks = frozenset(["no rank", "strain", "isolate", "forma specialis"])
+
+# NCBI taxid of Arthropoda, the subtree taken from nodes.dmp/names.dmp by default
+default_ncbi_root_taxon_id = 6656
+
+# Rows sent to SQLite per executemany call during a bulk load
+default_batch_size = 50000
+
+def create_taxons_table(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS taxons (
+            taxon_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            taxon_rank TEXT NOT NULL,
+            taxon_name TEXT NOT NULL,
+            parent_id INTEGER,
+            interval_start INTEGER,
+            interval_end INTEGER
+        )
+        ''')
+
+def create_taxonomy_versions_table(cursor):
+    # One row per import or update, so caches and photo databases can tell taxonomy releases apart
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS taxonomy_versions (
+            version INTEGER PRIMARY KEY AUTOINCREMENT,
+            imported_at TEXT NOT NULL,
+            source TEXT NOT NULL,
+            added INTEGER NOT NULL,
+            updated INTEGER NOT NULL,
+            removed INTEGER NOT NULL
+        )
+        ''')
 
-for line in lines:
-    if not line.strip():
-        continue
+def record_taxonomy_version(cursor, source, added, updated, removed):
+    create_taxonomy_versions_table(cursor)
+    cursor.execute(
+        "INSERT INTO taxonomy_versions (imported_at, source, added, updated, removed) VALUES (?, ?, ?, ?, ?)",
+        (time.strftime("%Y-%m-%dT%H:%M:%S"), os.path.basename(source), added, updated, removed)
+    )
+    return cursor.lastrowid
 
-    # Line's length without the indentations
-    stripped = line.lstrip()
-    # Detects indentations
-    indentation_level = len(line) - len(stripped)
+def create_taxons_indexes(cursor):
+    # Built after the load so the inserts don't have to maintain them row by row
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_taxons_parent_id ON taxons(parent_id)")
+    # NOCASE, so the search box's case-insensitive LIKE lookups can use it
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_taxons_taxon_name ON taxons(taxon_name COLLATE NOCASE)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_taxons_interval_start ON taxons(interval_start)")
 
-    regex_match = taxon_regex.match(stripped)
-    if not regex_match:
-        continue
+def set_bulk_load_pragmas(cursor):
+    # Import-time settings: a failed import is simply rerun, so durability is traded for speed
+    cursor.execute("PRAGMA journal_mode = MEMORY;")
+    cursor.execute("PRAGMA synchronous = OFF;")
+    cursor.execute("PRAGMA cache_size = -200000;")
+    cursor.execute("PRAGMA temp_store = MEMORY;")
 
-    taxon_id, taxon_rank, taxon_name = regex_match.groups()
-    taxon_rank = taxon_rank.strip().lower()
-    taxon_name = taxon_name.strip()
+def reset_bulk_load_pragmas(cursor):
+    cursor.execute("PRAGMA journal_mode = DELETE;")
+    cursor.execute("PRAGMA synchronous = FULL;")
 
-    # Skipping unnecessary or rarely used ranks.
-    ignored_ranks = ["no rank", "strain", "isolate", "forma specialis"]
-    if any(ignored_rank in taxon_rank for ignored_rank in ignored_ranks):
-        continue
+def read_dump_lines(input_file, use_mmap=False):
+    # Yields the dump a line at a time, so memory stays flat whatever its size.
+    # .gz files are decompressed on the fly; use_mmap reads plain files through a memory map.
+    if input_file.endswith(".gz"):
+        with gzip.open(input_file, "rt", encoding="utf-8") as dump_file:
+            yield from dump_file
+    elif use_mmap:
+        if os.path.getsize(input_file) == 0:
+            return
+        with open(input_file, "rb") as dump_file, \
+                mmap.mmap(dump_file.fileno(), 0, access=mmap.ACCESS_READ) as dump_map:
+            for line in iter(dump_map.readline, b""):
+                yield line.decode("utf-8")
+    else:
+        with open(input_file, encoding="utf-8") as dump_file:
+            yield from dump_file
 
+def is_ignored_name(taxon_name):
     # Filters out uncertain species, marked with sp., ssp., etc. Filters out environmental samples.
-    if "." in taxon_name or "environmental sample" in taxon_name:
-        continue
+    return "." in taxon_name or "environmental sample" in taxon_name
 
-    # Check whether list has enough levels
-    while len(parent_id_list) <= indentation_level:
-        parent_id_list.append(None)
+def is_ignored_taxon(taxon_rank, taxon_name):
+    return taxon_rank in ignored_ranks or is_ignored_name(taxon_name)
 
-    # Determine parent ID. Last taxon_id with lower indentation level.
-    parent_id = ""
-    for i in range(indentation_level - 1, -1, -1):
-        if parent_id_list[i] is not None:
-            parent_id = parent_id_list[i]
-            break
+def parse_taxonomy(lines):
+    # Open ancestors as (indentation level, taxon_id), innermost last
+    ancestors = []
 
-    # Update parent_id_list
-    parent_id_list[indentation_level] = taxon_id
+    for line in lines:
+        # Line's length without the indentations
+        stripped = line.lstrip()
+        if not stripped:
+            continue
+        # Detects indentations
+        indentation_level = len(line) - len(stripped)
 
-    # Adds current taxon to the output list
-    filter_output.append([taxon_id, taxon_rank, taxon_name, parent_id])
+        regex_match = taxon_regex.match(stripped)
+        if not regex_match:
+            continue
 
+        # Ancestors at this level or deeper are closed, even when this taxon itself is skipped,
+        # so children of a skipped taxon attach to its parent and not to a previous sibling
+        while ancestors and ancestors[-1][0] >= indentation_level:
+            ancestors.pop()
 
-    cursor.execute('''
-    INSERT INTO taxons (taxon_id, taxon_rank, taxon_name, parent_id) VALUES (?, ?, ?, ?)
-    ''', (taxon_id, taxon_rank, taxon_name, parent_id))
+        taxon_id, taxon_rank, taxon_name = regex_match.groups()
+        taxon_rank = taxon_rank.strip().lower()
+        taxon_name = taxon_name.strip()
+
+        if is_ignored_taxon(taxon_rank, taxon_name):
+            continue
+
+        # Parent is the innermost open taxon with a lower indentation level
+        parent_id = ancestors[-1][1] if ancestors else ""
+        ancestors.append((indentation_level, taxon_id))
+
+        yield taxon_id, taxon_rank, taxon_name, parent_id
+
+def read_ncbi_dump(dump_path):
+    # NCBI .dmp rows: fields separated by "\t|\t", each line ending in "\t|"
+    for line in read_dump_lines(dump_path):
+        line = line.rstrip("\r\n")
+        if line.endswith("\t|"):
+            line = line[:-2]
+        yield line.split("\t|\t")
+
+def parse_ncbi_taxonomy(nodes_path, names_path, root_taxon_id=default_ncbi_root_taxon_id):
+    # Reads the subtree under root_taxon_id straight from NCBI's nodes.dmp and names.dmp, with the same
+    # filters as parse_taxonomy. Only per-taxid arrays and the subtree's names are held in memory.
+    parent_ids = array("l")
+    ignored_rank_flags = bytearray()
+    for fields in read_ncbi_dump(nodes_path):
+        taxon_id = int(fields[0])
+        if taxon_id >= len(parent_ids):
+            parent_ids.extend([-1] * (taxon_id + 1 - len(parent_ids)))
+            ignored_rank_flags.extend(bytes(taxon_id + 1 - len(ignored_rank_flags)))
+        parent_ids[taxon_id] = int(fields[1])
+        ignored_rank_flags[taxon_id] = fields[2].strip().lower() in ignored_ranks
+
+    # 1 inside the subtree, 2 outside, 0 not worked out yet; settled for whole lineages at a time
+    in_subtree = bytearray(len(parent_ids))
+    if root_taxon_id < len(in_subtree):
+        in_subtree[root_taxon_id] = 1
+    for taxon_id in range(len(parent_ids)):
+        lineage = []
+        current = taxon_id
+        while in_subtree[current] == 0:
+            lineage.append(current)
+            parent_id = parent_ids[current]
+            if parent_id < 0 or parent_id >= len(parent_ids) or parent_id == current:
+                in_subtree[current] = 2
+                break
+            current = parent_id
+        state = in_subtree[current]
+        for lineage_id in lineage:
+            in_subtree[lineage_id] = state
+
+    taxon_names = {}
+    for fields in read_ncbi_dump(names_path):
+        if fields[3] == "scientific name":
+            taxon_id = int(fields[0])
+            if taxon_id < len(in_subtree) and in_subtree[taxon_id] == 1:
+                taxon_names[taxon_id] = fields[1]
+
+    def is_kept(taxon_id):
+        taxon_name = taxon_names.get(taxon_id)
+        return taxon_name is not None and not ignored_rank_flags[taxon_id] and not is_ignored_name(taxon_name)
+
+    # Skipped taxa hand their children to their nearest kept ancestor; -1 marks the subtree's top
+    kept_parent_ids = {}
+    def get_kept_parent_id(taxon_id):
+        lineage = []
+        current = parent_ids[taxon_id] if taxon_id != root_taxon_id else -1
+        while current != -1 and current not in kept_parent_ids:
+            if is_kept(current):
+                break
+            lineage.append(current)
+            current = parent_ids[current] if current != root_taxon_id else -1
+        kept_parent_id = kept_parent_ids.get(current, current)
+        for lineage_id in lineage:
+            kept_parent_ids[lineage_id] = kept_parent_id
+        return kept_parent_id
+
+    for fields in read_ncbi_dump(nodes_path):
+        taxon_id = int(fields[0])
+        if not is_kept(taxon_id):
+            continue
+        parent_id = get_kept_parent_id(taxon_id)
+        yield taxon_id, fields[2].strip().lower(), taxon_names[taxon_id], "" if parent_id == -1 else parent_id
+
+def read_ncbi_merged(merged_path):
+    # NCBI merged.dmp: old taxid -> the taxid it was merged into
+    return {int(fields[0]): int(fields[1]) for fields in read_ncbi_dump(merged_path)}
+
+def read_taxon_rows(input_file, use_mmap=False, names_file=None, root_taxon_id=default_ncbi_root_taxon_id):
+    # input_file is an indented dump (plain or .gz), or NCBI's nodes.dmp when names_file is given
+    if names_file is not None:
+        return parse_ncbi_taxonomy(input_file, names_file, root_taxon_id)
+    return parse_taxonomy(read_dump_lines(input_file, use_mmap))
+
+def insert_taxons(cursor, rows, batch_size=default_batch_size, table_name="taxons"):
+    inserted = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            cursor.executemany(f'''
+            INSERT INTO {table_name} (taxon_id, taxon_rank, taxon_name, parent_id) VALUES (?, ?, ?, ?)
+            ''', batch)
+            inserted += len(batch)
+            batch = []
+    if batch:
+        cursor.executemany(f'''
+        INSERT INTO {table_name} (taxon_id, taxon_rank, taxon_name, parent_id) VALUES (?, ?, ?, ?)
+        ''', batch)
+        inserted += len(batch)
+    return inserted
+
+def number_taxons(cursor, batch_size=default_batch_size):
+    # Pre-order numbering: interval_start is a taxon's position in a depth-first walk and interval_end
+    # the last position inside its subtree, so a taxon's descendants are exactly the taxa whose
+    # interval_start falls in its [interval_start, interval_end]. A subtree query is then one range scan.
+    children = {}
+    for taxon_id, parent_id in cursor.execute("SELECT taxon_id, parent_id FROM taxons ORDER BY taxon_id"):
+        children.setdefault(parent_id, []).append(taxon_id)
+
+    # Roots are taxa whose parent isn't in the table, usually parent_id ''
+    taxon_ids = {taxon_id for siblings in children.values() for taxon_id in siblings}
+    roots = [taxon_id for parent_id, siblings in children.items() if parent_id not in taxon_ids
+             for taxon_id in siblings]
+
+    # Iterative walk; ~taxon_id on the stack marks the point where that taxon's subtree closes
+    interval_starts = {}
+    intervals = []
+    position = 0
+    stack = [taxon_id for taxon_id in reversed(roots)]
+    while stack:
+        taxon_id = stack.pop()
+        if taxon_id < 0:
+            taxon_id = ~taxon_id
+            intervals.append((interval_starts.pop(taxon_id), position - 1, taxon_id))
+            if len(intervals) >= batch_size:
+                cursor.executemany("UPDATE taxons SET interval_start = ?, interval_end = ? WHERE taxon_id = ?",
+                                   intervals)
+                intervals = []
+            continue
+        interval_starts[taxon_id] = position
+        position += 1
+        stack.append(~taxon_id)
+        stack.extend(reversed(children.get(taxon_id, ())))
+    cursor.executemany("UPDATE taxons SET interval_start = ?, interval_end = ? WHERE taxon_id = ?", intervals)
+    return position
+
+def has_taxons_table(database_path):
+    if not os.path.exists(database_path):
+        return False
+    taxonomy = sqlite3.connect(database_path)
+    try:
+        return taxonomy.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'taxons'").fetchone() is not None
+    finally:
+        taxonomy.close()
+
+def import_taxonomy(input_file, database_path, batch_size=default_batch_size, use_mmap=False, names_file=None,
+                    root_taxon_id=default_ncbi_root_taxon_id):
+    taxon_rows = read_taxon_rows(input_file, use_mmap, names_file, root_taxon_id)
+
+    # isolation_level=None so the whole load runs in the one explicit transaction below
+    taxonomy = sqlite3.connect(database_path, isolation_level=None)
+    cursor = taxonomy.cursor()
+    cursor.execute("PRAGMA foreign_keys = ON;")
+    set_bulk_load_pragmas(cursor)
+
+    start_time = time.perf_counter()
+    cursor.execute("BEGIN")
+    try:
+        create_taxons_table(cursor)
+        inserted = insert_taxons(cursor, taxon_rows, batch_size)
+        number_taxons(cursor, batch_size)
+        create_taxons_indexes(cursor)
+        try:
+            create_taxon_search_index(cursor)
+        except sqlite3.OperationalError as error:
+            # SQLite built without FTS5 or the trigram tokenizer; the app falls back to LIKE scans
+            print(f"Taxon search index not created: {error}")
+        record_taxonomy_version(cursor, input_file, inserted, 0, 0)
+        cursor.execute("COMMIT")
+    except BaseException:
+        cursor.execute("ROLLBACK")
+        raise
+    finally:
+        reset_bulk_load_pragmas(cursor)
+        taxonomy.close()
+    elapsed = time.perf_counter() - start_time
+
+    return inserted, elapsed
+
+def update_taxonomy(input_file, database_path, batch_size=default_batch_size, use_mmap=False, names_file=None,
+                    root_taxon_id=default_ncbi_root_taxon_id, merged_file=None):
+    # Brings an existing taxonomy up to a new release in one transaction, writing only the rows that
+    # were added, changed or moved and deleting the ones gone from the release. Returns a summary
+    # with the removed taxa and, where known, the taxa they were merged into.
+    merged_into = read_ncbi_merged(merged_file) if merged_file else {}
+
+    taxonomy = sqlite3.connect(database_path, isolation_level=None)
+    cursor = taxonomy.cursor()
+    # The journal mode is left alone: switching it needs exclusive access, and in WAL mode
+    # a running gallery keeps reading the old release until the update commits
+    cursor.execute("PRAGMA cache_size = -200000;")
+    cursor.execute("PRAGMA temp_store = MEMORY;")
+    cursor.execute("PRAGMA busy_timeout = 5000;")
+
+    start_time = time.perf_counter()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        # Taxonomy databases from before interval numbering
+        taxon_columns = {row[1] for row in cursor.execute("PRAGMA table_info(taxons)")}
+        for column in ("interval_start", "interval_end"):
+            if column not in taxon_columns:
+                cursor.execute(f"ALTER TABLE taxons ADD COLUMN {column} INTEGER")
+
+        cursor.execute('''
+            CREATE TEMP TABLE new_taxons (
+                taxon_id INTEGER PRIMARY KEY,
+                taxon_rank TEXT NOT NULL,
+                taxon_name TEXT NOT NULL,
+                parent_id INTEGER
+            )
+            ''')
+        insert_taxons(cursor, read_taxon_rows(input_file, use_mmap, names_file, root_taxon_id), batch_size,
+                      "temp.new_taxons")
+
+        removed_rows = cursor.execute('''
+            SELECT taxon_id, taxon_name, taxon_rank FROM taxons
+            WHERE taxon_id NOT IN (SELECT taxon_id FROM temp.new_taxons)
+            ''').fetchall()
+        added_rows = cursor.execute('''
+            SELECT taxon_id, taxon_name FROM temp.new_taxons
+            WHERE taxon_id NOT IN (SELECT taxon_id FROM taxons)
+            ''').fetchall()
+        # (taxon_id, old name, new name, moved) for rows present in both releases that differ
+        changed_rows = cursor.execute('''
+            SELECT taxons.taxon_id, taxons.taxon_name, new_taxons.taxon_name,
+                   taxons.parent_id IS NOT new_taxons.parent_id
+            FROM taxons
+            JOIN temp.new_taxons ON new_taxons.taxon_id = taxons.taxon_id
+            WHERE taxons.taxon_rank IS NOT new_taxons.taxon_rank
+               OR taxons.taxon_name IS NOT new_taxons.taxon_name
+               OR taxons.parent_id IS NOT new_taxons.parent_id
+            ''').fetchall()
+
+        # Without merged.dmp, a removed taxon whose name and rank reappear under one new id counts as merged
+        if removed_rows and not merged_file:
+            cursor.execute("CREATE INDEX temp.idx_new_taxons_taxon_name ON new_taxons(taxon_name)")
+            for taxon_id, taxon_name, taxon_rank in removed_rows:
+                matches = cursor.execute(
+                    "SELECT taxon_id FROM temp.new_taxons WHERE taxon_name = ? AND taxon_rank = ? LIMIT 2",
+                    (taxon_name, taxon_rank)).fetchall()
+                if len(matches) == 1:
+                    merged_into[taxon_id] = matches[0][0]
+
+        # The search index has to drop the old names while they are still in taxons
+        renamed_rows = [(taxon_id, new_name) for taxon_id, old_name, new_name, _ in changed_rows
+                        if old_name != new_name]
+        use_search_index = has_taxon_search_index(cursor)
+        if use_search_index:
+            delete_taxon_search_entries(cursor, [(taxon_id, taxon_name) for taxon_id, taxon_name, _ in removed_rows])
+            delete_taxon_search_entries(cursor, [(taxon_id, old_name) for taxon_id, old_name, new_name, _
+                                                 in changed_rows if old_name != new_name])
+
+        cursor.executemany("DELETE FROM taxons WHERE taxon_id = ?", ((row[0],) for row in removed_rows))
+        cursor.execute('''
+            INSERT INTO taxons (taxon_id, taxon_rank, taxon_name, parent_id)
+            SELECT taxon_id, taxon_rank, taxon_name, parent_id FROM temp.new_taxons WHERE true
+            ON CONFLICT(taxon_id) DO UPDATE SET
+                taxon_rank = excluded.taxon_rank,
+                taxon_name = excluded.taxon_name,
+                parent_id = excluded.parent_id
+            WHERE taxon_rank IS NOT excluded.taxon_rank
+               OR taxon_name IS NOT excluded.taxon_name
+               OR parent_id IS NOT excluded.parent_id
+            ''')
+
+        if use_search_index:
+            insert_taxon_search_entries(cursor, added_rows + renamed_rows)
+        unnumbered = cursor.execute("SELECT 1 FROM taxons WHERE interval_start IS NULL LIMIT 1").fetchone()
+        if added_rows or removed_rows or any(moved for _, _, _, moved in changed_rows) or unnumbered:
+            number_taxons(cursor, batch_size)
+        create_taxons_indexes(cursor)
+        cursor.execute("DROP TABLE temp.new_taxons")
+        # An unchanged release keeps its version, which tree caches are keyed on
+        if added_rows or changed_rows or removed_rows:
+            version = record_taxonomy_version(cursor, input_file, len(added_rows), len(changed_rows),
+                                              len(removed_rows))
+        else:
+            version = get_taxonomy_version(cursor)
+        cursor.execute("COMMIT")
+    except BaseException:
+        cursor.execute("ROLLBACK")
+        raise
+    finally:
+        taxonomy.close()
+    elapsed = time.perf_counter() - start_time
+
+    return {
+        "version": version,
+        "added": len(added_rows),
+        "updated": len(changed_rows),
+        "moved": [taxon_id for taxon_id, _, _, moved in changed_rows if moved],
+        "removed": removed_rows,
+        "merged_into": {taxon_id: merged_into[taxon_id] for taxon_id, _, _ in removed_rows if taxon_id in merged_into},
+        "elapsed": elapsed,
+    }
+
+def update_photo_databases(photo_database_paths, update):
+    # Makes each photo database look up the lineage of moved and removed taxa again, and returns
+    # (photo database path, taxon_id, taxon name, photo count, merged into) for photos of removed taxa
+    removed_names = {taxon_id: taxon_name for taxon_id, taxon_name, _ in update["removed"]}
+    stale_taxon_ids = update["moved"] + list(removed_names)
+    affected_photos = []
+    for photo_database_path in photo_database_paths:
+        photo_database = open_photo_database(photo_database_path)
+        with photo_database.transaction() as connection:
+            forget_taxon_lineage(connection, stale_taxon_ids)
+        photo_counts = get_photo_counts(photo_database.reader().cursor(), removed_names)
+        for taxon_id, (photo_count, _) in sorted(photo_counts.items()):
+            if photo_count:
+                affected_photos.append((photo_database_path, taxon_id, removed_names[taxon_id], photo_count,
+                                        update["merged_into"].get(taxon_id)))
+    return affected_photos
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build taxonomy.db from an indented taxonomy dump")
+    parser.add_argument("input_file", nargs="?", default="arthropoda_ids.txt",
+                        help="indented dump (optionally .gz), or NCBI nodes.dmp together with --names")
+    parser.add_argument("--names", default=None, help="NCBI names.dmp, to read nodes.dmp directly")
+    parser.add_argument("--root", type=int, default=default_ncbi_root_taxon_id,
+                        help="NCBI taxid whose subtree is imported from nodes.dmp (default: Arthropoda)")
+    parser.add_argument("--mmap", action="store_true", help="read a plain dump through a memory map")
+    parser.add_argument("--merged", default=None,
+                        help="NCBI merged.dmp, to report which taxon a removed one was merged into")
+    parser.add_argument("--photo-databases", nargs="*", default=None,
+                        help="photo databases to check after an update (default: databases/*.db)")
+    parser.add_argument("--database", default=None, help="path of the taxonomy database to create")
+    parser.add_argument("--batch-size", type=int, default=default_batch_size,
+                        help="rows inserted per executemany call")
+    args = parser.parse_args(argv)
+
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    database_path = args.database or os.path.join(base_dir, 'taxonomy.db')
+
+    # An existing taxonomy is updated in place; only the differences are written
+    if has_taxons_table(database_path):
+        update = update_taxonomy(args.input_file, database_path, args.batch_size, args.mmap, args.names,
+                                 args.root, args.merged)
+        print(f"Updated to taxonomy version {update['version']} in {update['elapsed']:.2f} s: "
+              f"{update['added']} added, {update['updated']} changed ({len(update['moved'])} moved), "
+              f"{len(update['removed'])} removed")
 
-taxonomy.commit()
-taxonomy.close()
+        photo_database_paths = args.photo_databases
+        if photo_database_paths is None:
+            photo_database_paths = sorted(glob(os.path.join(base_dir, 'databases', '*.db')))
+        for photo_database_path, taxon_id, taxon_name, photo_count, merged_taxon_id in update_photo_databases(
+                photo_database_paths, update):
+            status = "removed" if merged_taxon_id is None else f"merged into {merged_taxon_id}"
+            print(f"{photo_database_path}: {photo_count} photos of {taxon_name} ({taxon_id}), {status}")
+        close_all_databases()
+        return
 
+    inserted, elapsed = import_taxonomy(args.input_file, database_path, args.batch_size, args.mmap,
+                                        args.names, args.root)
+    rows_per_second = inserted / elapsed if elapsed > 0 else float("inf")
 
+    print("Data filtering and reformatting complete")
+    print(f"Inserted {inserted} taxons in {elapsed:.2f} s ({rows_per_second:.0f} rows/s)")
 
-print("Data filtering and reformatting complete")
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,118 @@
+import os
+import pathlib
+import sqlite3
+import threading
+import weakref
+from contextlib import contextmanager
+from instrumentation import get_connection_factory
+
+# Prepared statements kept per connection by sqlite3's statement cache
+statement_cache_size = 256
+
+databases = {}
+databases_lock = threading.Lock()
+
+def get_database(database_path):
+    # One shared Database per file, so the whole app reuses the same connections
+    database_path = os.path.abspath(database_path)
+    with databases_lock:
+        database = databases.get(database_path)
+        if database is None:
+            database = Database(database_path)
+            databases[database_path] = database
+        return database
+
+def close_all_databases():
+    with databases_lock:
+        for database in databases.values():
+            database.close()
+        databases.clear()
+
+def open_read_only(database_path):
+    # Plain connection that can't change the file at all, not even its journal mode; the caller closes it
+    database_uri = pathlib.Path(os.path.abspath(database_path)).as_uri() + "?mode=ro"
+    connection = sqlite3.connect(database_uri, uri=True, isolation_level=None, check_same_thread=False,
+                                 cached_statements=statement_cache_size, factory=get_connection_factory())
+    connection.execute("PRAGMA temp_store = MEMORY;")
+    connection.execute("PRAGMA busy_timeout = 5000;")
+    return connection
+
+def table_exists(cursor, table_name):
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table_name,))
+    return cursor.fetchone() is not None
+
+class ReaderHolder:
+    # Kept in a thread's local storage only, so it goes away with the thread
+    def __init__(self, connection):
+        self.connection = connection
+
+class Database:
+    # Owns the long-lived connections to one SQLite file: a single writer shared behind a lock
+    # and one autocommit reader per thread. WAL lets the readers run while the writer commits.
+    def __init__(self, database_path):
+        self.database_path = database_path
+        self.write_lock = threading.RLock()
+        self.write_connection = None
+        self.local = threading.local()
+        self.connections = []
+        self.connections_lock = threading.Lock()
+
+    def connect(self):
+        # isolation_level=None: readers never sit in a stale implicit transaction,
+        # and the writer's transactions are opened explicitly in transaction()
+        connection = sqlite3.connect(self.database_path, isolation_level=None, check_same_thread=False,
+                                     cached_statements=statement_cache_size, factory=get_connection_factory())
+        connection.execute("PRAGMA journal_mode = WAL;")
+        connection.execute("PRAGMA synchronous = NORMAL;")
+        connection.execute("PRAGMA cache_size = -20000;")
+        connection.execute("PRAGMA temp_store = MEMORY;")
+        connection.execute("PRAGMA busy_timeout = 5000;")
+        with self.connections_lock:
+            self.connections.append(connection)
+        return connection
+
+    def reader(self):
+        # Read connection for the calling thread; safe to use from worker threads.
+        # Closed when the thread exits, or earlier through release_reader().
+        holder = getattr(self.local, "reader", None)
+        if holder is None:
+            holder = ReaderHolder(self.connect())
+            weakref.finalize(holder, self.close_connection, holder.connection)
+            self.local.reader = holder
+        return holder.connection
+
+    def release_reader(self):
+        # For tasks on pooled threads, which may sit idle for long or never exit
+        if getattr(self.local, "reader", None) is not None:
+            del self.local.reader
+
+    def close_connection(self, connection):
+        with self.connections_lock:
+            if connection not in self.connections:
+                return
+            self.connections.remove(connection)
+        connection.close()
+
+    @contextmanager
+    def transaction(self):
+        with self.write_lock:
+            if self.write_connection is None:
+                self.write_connection = self.connect()
+            connection = self.write_connection
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                # An interrupted write may already have rolled the transaction back
+                if connection.in_transaction:
+                    connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+    def close(self):
+        with self.connections_lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections.clear()
+        self.write_connection = None
+        self.local = threading.local()
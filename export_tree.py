@@ -0,0 +1,262 @@
+import os
+import sys
+import math
+import zlib
+import struct
+import argparse
+import time
+
+# Before Qt is loaded, so exports run on a server without a display
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt6.QtWidgets import QApplication
+from PyQt6.QtGui import QImage, QPainter, QPen, QPdfWriter, QPageSize
+from PyQt6.QtCore import Qt, QPointF, QRectF, QSize, QSizeF, QMarginsF
+from PyQt6.QtSvg import QSvgGenerator
+from database import close_all_databases
+from photo_database import get_photo_database_path
+from tree_layout import get_node_label, get_layout_bounds, TreeLayoutIndex
+from arthropod_gallery import (load_phylogenetic_tree, get_heat_color, text_level_of_detail, tree_level_height,
+                               tree_sibling_spacing, tree_expander_size)
+
+export_formats = ("png", "pdf", "svg")
+# Raster tiles are rendered this many pixels wide and at most this tall
+default_tile_size = 2048
+# Rows of the output image held in memory at once, across all tiles of a band
+default_band_bytes = 64 * 1024 * 1024
+# Largest PDF page most viewers open, 200 inches; bigger trees are scaled down to fit
+max_pdf_page_points = 14400
+# Compressed PNG data written per IDAT chunk
+png_chunk_bytes = 1024 * 1024
+
+class PngStreamWriter:
+    # 8-bit RGB PNG written a band of rows at a time, so the whole image is never in memory
+    def __init__(self, output_file, width, height, compression_level=6):
+        self.output_file = output_file
+        self.width = width
+        self.height = height
+        self.compressor = zlib.compressobj(compression_level)
+        self.compressed = []
+        self.compressed_bytes = 0
+
+        output_file.write(b"\x89PNG\r\n\x1a\n")
+        # 8 bits per channel, color type 2 (RGB), default compression and filtering, no interlace
+        self.write_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+
+    def write_chunk(self, chunk_type, data):
+        self.output_file.write(struct.pack(">I", len(data)) + chunk_type + data)
+        self.output_file.write(struct.pack(">I", zlib.crc32(chunk_type + data)))
+
+    def write_rows(self, band, row_count):
+        # band holds row_count rows of width * 3 bytes; every row gets filter type 0
+        row_bytes = self.width * 3
+        for row in range(row_count):
+            self.add_compressed(self.compressor.compress(b"\x00" + band[row * row_bytes:(row + 1) * row_bytes]))
+
+    def add_compressed(self, data):
+        if not data:
+            return
+        self.compressed.append(data)
+        self.compressed_bytes += len(data)
+        if self.compressed_bytes >= png_chunk_bytes:
+            self.flush_chunk()
+
+    def flush_chunk(self):
+        if self.compressed:
+            self.write_chunk(b"IDAT", b"".join(self.compressed))
+        self.compressed = []
+        self.compressed_bytes = 0
+
+    def close(self):
+        self.add_compressed(self.compressor.flush())
+        self.flush_chunk()
+        self.write_chunk(b"IEND", b"")
+
+class TreePainter:
+    # Paints laid-out nodes straight onto a QPainter, looking like the tree window's items but
+    # without building a scene. Collapsed subtrees get a "+" marker.
+    def __init__(self, loaded_tree):
+        self.font = loaded_tree.tree_metrics.font
+        self.collapsed_nodes = loaded_tree.collapsed_nodes
+        self.max_photo_count = max((node.subtree_photo_count for node in loaded_tree.tree_data), default=1)
+        self.pen = QPen(Qt.GlobalColor.black)
+        self.photo_pen = QPen(Qt.GlobalColor.black, 2)
+
+    def paint(self, painter, layout_nodes, draw_labels=True):
+        layout_nodes = list(layout_nodes)
+
+        # Lines under the boxes, as in the window
+        painter.setPen(self.pen)
+        for layout_node in layout_nodes:
+            parent = layout_node.parent
+            if parent is not None:
+                painter.drawLine(QPointF(parent.x_center, parent.y + parent.height),
+                                 QPointF(layout_node.x_center, layout_node.y))
+
+        painter.setFont(self.font)
+        for layout_node in layout_nodes:
+            node = layout_node.node
+            box = QRectF(layout_node.x, layout_node.y, layout_node.width, layout_node.height)
+            painter.setPen(self.photo_pen if node.has_photos else self.pen)
+            painter.setBrush(get_heat_color(node.subtree_photo_count, self.max_photo_count))
+            painter.drawRect(box)
+            if draw_labels:
+                painter.drawText(box, Qt.AlignmentFlag.AlignCenter, get_node_label(node))
+
+            if node.id in self.collapsed_nodes:
+                marker = QRectF(layout_node.x + layout_node.width + 2,
+                                layout_node.y + (layout_node.height - tree_expander_size) / 2,
+                                tree_expander_size, tree_expander_size)
+                painter.setPen(self.pen)
+                painter.setBrush(Qt.GlobalColor.white)
+                painter.drawRect(marker)
+                if draw_labels:
+                    painter.drawText(marker, Qt.AlignmentFlag.AlignCenter, "+")
+
+def get_export_bounds(layout_nodes):
+    # Scene rectangle of the whole tree with the window's margin, and room for collapse markers
+    left, top, right, bottom = get_layout_bounds(layout_nodes)
+    margin = tree_sibling_spacing
+    return left - margin, top - margin, right + margin + tree_expander_size, bottom + margin
+
+def export_png(tree_painter, layout_nodes, output_path, scale, tile_size=default_tile_size,
+               band_bytes=default_band_bytes, progress=None):
+    left, top, right, bottom = get_export_bounds(layout_nodes)
+    width = max(1, math.ceil((right - left) * scale))
+    height = max(1, math.ceil((bottom - top) * scale))
+    # Bands as tall as a tile, or shorter when a full-width band would go over the memory budget
+    band_height = max(1, min(tile_size, band_bytes // (width * 3)))
+
+    layout_index = TreeLayoutIndex(layout_nodes, tree_level_height)
+    draw_labels = scale >= text_level_of_detail
+    # Thick outlines and collapse markers reach past the boxes the index knows about
+    query_margin = tree_expander_size + 4
+
+    with open(output_path, "wb") as output_file:
+        png_writer = PngStreamWriter(output_file, width, height)
+        for band_top in range(0, height, band_height):
+            rows = min(band_height, height - band_top)
+            band = bytearray(width * 3 * rows)
+            for tile_left in range(0, width, tile_size):
+                columns = min(tile_size, width - tile_left)
+                tile = QImage(columns, rows, QImage.Format.Format_RGB32)
+                tile.fill(Qt.GlobalColor.white)
+
+                scene_left = left + tile_left / scale
+                scene_top = top + band_top / scale
+                painter = QPainter(tile)
+                painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+                painter.setRenderHint(QPainter.RenderHint.TextAntialiasing)
+                painter.scale(scale, scale)
+                painter.translate(-scene_left, -scene_top)
+                tree_painter.paint(painter, layout_index.query(
+                    scene_left - query_margin, scene_top - query_margin,
+                    scene_left + columns / scale + query_margin, scene_top + rows / scale + query_margin
+                ), draw_labels)
+                painter.end()
+
+                tile = tile.convertToFormat(QImage.Format.Format_RGB888)
+                tile_bytes = tile.constBits().asstring(tile.sizeInBytes())
+                bytes_per_line = tile.bytesPerLine()
+                for row in range(rows):
+                    start = (row * width + tile_left) * 3
+                    band[start:start + columns * 3] = tile_bytes[row * bytes_per_line:
+                                                                 row * bytes_per_line + columns * 3]
+            png_writer.write_rows(band, rows)
+            if progress is not None:
+                progress(band_top + rows, height)
+        png_writer.close()
+    return width, height
+
+def export_vector(tree_painter, layout_nodes, output_path, output_format, scale):
+    # SVG and PDF are drawn in one pass; one unit is one point
+    left, top, right, bottom = get_export_bounds(layout_nodes)
+    if output_format == "pdf":
+        scale = min(scale, max_pdf_page_points / max(right - left, bottom - top))
+    width = (right - left) * scale
+    height = (bottom - top) * scale
+
+    if output_format == "svg":
+        device = QSvgGenerator()
+        device.setFileName(output_path)
+        device.setSize(QSize(math.ceil(width), math.ceil(height)))
+        device.setViewBox(QRectF(0, 0, width, height))
+        device.setTitle("Phylogenetic Tree")
+    else:
+        device = QPdfWriter(output_path)
+        device.setResolution(72)
+        device.setTitle("Phylogenetic Tree")
+        device.setPageSize(QPageSize(QSizeF(width, height), QPageSize.Unit.Point, "Phylogenetic Tree"))
+        device.setPageMargins(QMarginsF(0, 0, 0, 0))
+
+    painter = QPainter(device)
+    painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+    painter.scale(scale, scale)
+    painter.translate(-left, -top)
+    tree_painter.paint(painter, layout_nodes)
+    painter.end()
+    return width, height
+
+def print_stage(stage_name, stage, stages):
+    print(f"{stage_name} ({stage + 1}/{stages})", flush=True)
+
+def print_progress(done, total):
+    print(f"\rRendered {done}/{total} rows", end="" if done < total else "\n", flush=True)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render a gallery's phylogenetic tree to SVG, PDF or PNG without a display")
+    parser.add_argument("database_name", help="photo database, as in databases/<name>.db")
+    parser.add_argument("output", help="output file; the format is taken from its extension unless --format is given")
+    parser.add_argument("--format", dest="output_format", choices=export_formats, default=None)
+    parser.add_argument("--collapse-rank", default="none",
+                        help="draw subtrees at or below this rank collapsed (default: everything expanded)")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="pixels (PNG) or points (PDF, SVG) per unit of the tree view")
+    parser.add_argument("--tile-size", type=int, default=default_tile_size, help="edge of a PNG tile in pixels")
+    parser.add_argument("--band-memory", type=int, default=default_band_bytes // (1024 * 1024),
+                        help="MB of PNG rows held in memory at once")
+    parser.add_argument("--taxonomy", default=None, help="path of taxonomy.db")
+    args = parser.parse_args(argv)
+
+    output_format = args.output_format or os.path.splitext(args.output)[1].lstrip(".").lower()
+    if output_format not in export_formats:
+        parser.error("can't tell the format from the file name, use --format")
+    if args.scale <= 0 or args.tile_size <= 0 or args.band_memory <= 0:
+        parser.error("--scale, --tile-size and --band-memory must be positive")
+
+    photo_database_path = get_photo_database_path(args.database_name)
+    if not os.path.isfile(photo_database_path):
+        print(f"Database not found: {photo_database_path}")
+        return 1
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    taxonomy_database_path = args.taxonomy or os.path.join(base_dir, 'taxonomy.db')
+    collapse_rank = None if args.collapse_rank == "none" else args.collapse_rank
+
+    application = QApplication.instance() or QApplication(sys.argv[:1])
+
+    start_time = time.perf_counter()
+    # Read-only: neither database is migrated or written to, so an export leaves alone a gallery the app may have open
+    loaded_tree = load_phylogenetic_tree(photo_database_path, taxonomy_database_path, collapse_rank,
+                                         progress=print_stage, read_only=True)
+    close_all_databases()
+    if not loaded_tree.layout_nodes:
+        print("No photos to draw a tree from")
+        return 1
+
+    tree_painter = TreePainter(loaded_tree)
+    if output_format == "png":
+        width, height = export_png(tree_painter, loaded_tree.layout_nodes, args.output, args.scale,
+                                   args.tile_size, args.band_memory * 1024 * 1024, print_progress)
+        size = f"{width}x{height} px"
+    else:
+        width, height = export_vector(tree_painter, loaded_tree.layout_nodes, args.output, output_format,
+                                      args.scale)
+        size = f"{width:.0f}x{height:.0f} pt"
+    elapsed = time.perf_counter() - start_time
+    application.quit()
+
+    print(f"Wrote {len(loaded_tree.layout_nodes)} taxa to {args.output} ({size}) in {elapsed:.2f} s")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
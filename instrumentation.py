@@ -0,0 +1,206 @@
+import os
+import sys
+import json
+import time
+import atexit
+import sqlite3
+import cProfile
+import pstats
+import threading
+from functools import wraps
+from contextlib import contextmanager
+
+# Opt-in hot-path instrumentation. Off unless switched on through the environment
+# (ARTHROPOD_GALLERY_PROFILE, ARTHROPOD_GALLERY_TRACE, ARTHROPOD_GALLERY_CPROFILE) or enable().
+# While off, span() and count() return immediately.
+
+enabled = False
+trace_path = None
+profiled_stages = set()
+
+records_lock = threading.Lock()
+spans = []  # (name, thread id, start, duration, sql queries, sql seconds)
+counters = {}
+local = threading.local()
+start_time = time.perf_counter()
+
+def enable(trace_file=None, cprofile_stages=(), report=True):
+    global enabled, trace_path, profiled_stages
+    enabled = True
+    trace_path = trace_file
+    profiled_stages = set(cprofile_stages)
+    if report:
+        atexit.register(report_at_exit)
+
+def enable_from_environment():
+    profile = os.environ.get("ARTHROPOD_GALLERY_PROFILE", "")
+    trace_file = os.environ.get("ARTHROPOD_GALLERY_TRACE") or None
+    cprofile_stages = [stage for stage in os.environ.get("ARTHROPOD_GALLERY_CPROFILE", "").split(",") if stage]
+    if profile not in ("", "0") or trace_file or cprofile_stages:
+        enable(trace_file, cprofile_stages)
+
+class SpanState:
+    __slots__ = ("sql_queries", "sql_seconds")
+
+    def __init__(self):
+        self.sql_queries = 0
+        self.sql_seconds = 0.0
+
+def get_span_stack():
+    stack = getattr(local, "stack", None)
+    if stack is None:
+        stack = []
+        local.stack = stack
+    return stack
+
+@contextmanager
+def span(name):
+    if not enabled:
+        yield
+        return
+
+    stack = get_span_stack()
+    state = SpanState()
+    stack.append(state)
+    profiler = None
+    if name in profiled_stages:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is already running, e.g. the same stage on another thread
+            profiler = None
+    span_start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - span_start
+        if profiler is not None:
+            profiler.disable()
+            write_profile(name, profiler)
+        stack.pop()
+        # SQL run inside a nested span counts towards its parents too
+        if stack:
+            stack[-1].sql_queries += state.sql_queries
+            stack[-1].sql_seconds += state.sql_seconds
+        with records_lock:
+            spans.append((name, threading.get_ident(), span_start - start_time, duration,
+                          state.sql_queries, state.sql_seconds))
+
+def timed(name=None):
+    # Decorator form of span(), named after the function unless a name is given
+    def decorator(function):
+        span_name = name or function.__name__
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with span(span_name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(name, amount=1):
+    if not enabled:
+        return
+    with records_lock:
+        counters[name] = counters.get(name, 0) + amount
+
+def record_sql(seconds):
+    count("sql_queries")
+    stack = get_span_stack()
+    if stack:
+        stack[-1].sql_queries += 1
+        stack[-1].sql_seconds += seconds
+
+class InstrumentedCursor(sqlite3.Cursor):
+    # Times execute calls; for a SELECT that covers preparing it and fetching the first row
+    def execute(self, *args):
+        query_start = time.perf_counter()
+        try:
+            return super().execute(*args)
+        finally:
+            record_sql(time.perf_counter() - query_start)
+
+    def executemany(self, *args):
+        query_start = time.perf_counter()
+        try:
+            return super().executemany(*args)
+        finally:
+            record_sql(time.perf_counter() - query_start)
+
+class InstrumentedConnection(sqlite3.Connection):
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+def get_connection_factory():
+    return InstrumentedConnection if enabled else sqlite3.Connection
+
+def write_profile(name, profiler):
+    profile_path = f"profile_{name}.prof"
+    profiler.dump_stats(profile_path)
+    print(f"cProfile of {name} written to {profile_path}", file=sys.stderr)
+    pstats.Stats(profiler, stream=sys.stderr).sort_stats("cumulative").print_stats(15)
+
+def summary_table():
+    with records_lock:
+        span_records = list(spans)
+        counter_records = dict(counters)
+
+    totals = {}
+    for name, _, _, duration, sql_queries, sql_seconds in span_records:
+        total = totals.setdefault(name, [0, 0.0, 0.0, 0, 0.0])
+        total[0] += 1
+        total[1] += duration
+        total[2] = max(total[2], duration)
+        total[3] += sql_queries
+        total[4] += sql_seconds
+
+    lines = [f"{'stage':<28}{'calls':>7}{'total ms':>11}{'mean ms':>10}{'max ms':>10}{'sql':>7}{'sql ms':>10}"]
+    for name, (calls, duration, longest, sql_queries, sql_seconds) in sorted(
+            totals.items(), key=lambda item: -item[1][1]):
+        lines.append(f"{name:<28}{calls:>7}{duration * 1000:>11.2f}{duration * 1000 / calls:>10.2f}"
+                     f"{longest * 1000:>10.2f}{sql_queries:>7}{sql_seconds * 1000:>10.2f}")
+    if counter_records:
+        lines.append("")
+        lines.append(f"{'counter':<28}{'value':>10}")
+        for name, value in sorted(counter_records.items()):
+            lines.append(f"{name:<28}{value:>10}")
+    return "\n".join(lines)
+
+def write_chrome_trace(path):
+    # Chrome trace event format, viewable in chrome://tracing or Perfetto
+    with records_lock:
+        span_records = list(spans)
+        counter_records = dict(counters)
+
+    process_id = os.getpid()
+    trace_events = []
+    end = 0.0
+    for name, thread_id, span_start, duration, sql_queries, sql_seconds in span_records:
+        trace_events.append({
+            "name": name, "ph": "X", "pid": process_id, "tid": thread_id,
+            "ts": span_start * 1e6, "dur": duration * 1e6,
+            "args": {"sql_queries": sql_queries, "sql_ms": sql_seconds * 1000},
+        })
+        end = max(end, span_start + duration)
+    for name, value in counter_records.items():
+        trace_events.append({"name": name, "ph": "C", "pid": process_id, "ts": end * 1e6, "args": {name: value}})
+
+    with open(path, "w") as trace_file:
+        json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, trace_file)
+
+def report_at_exit():
+    print(summary_table(), file=sys.stderr)
+    if trace_path:
+        write_chrome_trace(trace_path)
+        print(f"Chrome trace written to {trace_path}", file=sys.stderr)
+
+enable_from_environment()
@@ -0,0 +1,365 @@
+import os
+import shutil
+import hashlib
+import threading
+from database import get_database
+from taxon_tree import get_taxon_lineage, load_taxon_id_table
+from photo_metadata import read_photo_metadata
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+default_taxonomy_database_path = os.path.join(base_dir, 'taxonomy.db')
+
+# Linux FICLONE ioctl: copy-on-write clone of a whole file (btrfs, XFS, ...)
+ficlone_request = 0x40049409
+
+# Photo databases whose schema has already been brought up to date in this process
+checked_databases = set()
+checked_databases_lock = threading.Lock()
+
+def get_photo_database_path(database_name):
+    return os.path.join(base_dir, 'databases', database_name + '.db')
+
+def get_photo_folder_path(database_name):
+    return os.path.join(base_dir, 'images', database_name)
+
+def create_photos_schema(connection):
+    # Create photos table
+    connection.execute('''
+    CREATE TABLE IF NOT EXISTS photos (
+        photo_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        taxon_id INTEGER NOT NULL,
+        filepath TEXT NOT NULL,
+        content_hash TEXT,
+        byte_size INTEGER,
+        mtime REAL,
+        FOREIGN KEY(taxon_id) REFERENCES taxons(taxon_id) ON DELETE CASCADE
+    )
+    ''')
+
+    # Databases created before content-addressed storage
+    photo_columns = {row[1] for row in connection.execute("PRAGMA table_info(photos)")}
+    for column, column_type in (("content_hash", "TEXT"), ("byte_size", "INTEGER"), ("mtime", "REAL")):
+        if column not in photo_columns:
+            connection.execute(f"ALTER TABLE photos ADD COLUMN {column} {column_type}")
+
+    connection.execute("CREATE INDEX IF NOT EXISTS idx_photos_filepath ON photos(filepath)")
+    connection.execute("CREATE INDEX IF NOT EXISTS idx_photos_content_hash ON photos(content_hash)")
+    connection.execute("CREATE INDEX IF NOT EXISTS idx_photos_taxon_id ON photos(taxon_id)")
+
+    # Read from the file headers once, when a photo is stored. Keyed by content, like the stored files.
+    connection.execute('''
+    CREATE TABLE IF NOT EXISTS photo_metadata (
+        content_hash TEXT PRIMARY KEY,
+        width INTEGER,
+        height INTEGER,
+        captured_at TEXT,
+        orientation INTEGER,
+        camera TEXT
+    )
+    ''')
+    connection.execute("CREATE INDEX IF NOT EXISTS idx_photo_metadata_captured_at ON photo_metadata(captured_at)")
+    connection.execute("CREATE INDEX IF NOT EXISTS idx_photo_metadata_camera ON photo_metadata(camera)")
+
+    create_photo_counts_schema(connection)
+    create_photo_version_schema(connection)
+
+def create_photo_version_schema(connection):
+    # Bumped whenever photos are added, removed or moved to another taxon, so caches built from the
+    # photos can tell they're stale. database_id tells apart a database recreated under the same name.
+    connection.execute('''
+    CREATE TABLE IF NOT EXISTS photo_database_version (
+        database_id TEXT NOT NULL,
+        version INTEGER NOT NULL
+    )
+    ''')
+    connection.execute('''
+    INSERT INTO photo_database_version (database_id, version)
+    SELECT lower(hex(randomblob(8))), 0 WHERE NOT EXISTS (SELECT 1 FROM photo_database_version)
+    ''')
+    for trigger_name, event in (("photos_version_insert", "INSERT"), ("photos_version_delete", "DELETE"),
+                                ("photos_version_update", "UPDATE OF taxon_id")):
+        connection.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {trigger_name} AFTER {event} ON photos
+        BEGIN
+            UPDATE photo_database_version SET version = version + 1;
+        END
+        ''')
+
+def get_photo_database_version(cursor):
+    # "database id:version", which changes with every change to the photos
+    cursor.execute("SELECT database_id, version FROM photo_database_version")
+    database_id, version = cursor.fetchone()
+    return f"{database_id}:{version}"
+
+def create_photo_counts_schema(connection):
+    counts_exist = connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'taxon_photo_counts'").fetchone() is not None
+
+    # Photos of each taxon and of its whole subtree. Rows cover photographed taxa and all their
+    # ancestors; parent_id is '' for a root and NULL while the taxon's lineage isn't recorded yet.
+    connection.execute('''
+    CREATE TABLE IF NOT EXISTS taxon_photo_counts (
+        taxon_id INTEGER PRIMARY KEY,
+        parent_id INTEGER,
+        direct_count INTEGER NOT NULL DEFAULT 0,
+        subtree_count INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+
+    # Kept up to date by triggers, so every way of adding or removing photos maintains them
+    connection.execute('''
+    CREATE TRIGGER IF NOT EXISTS photos_count_insert AFTER INSERT ON photos
+    BEGIN
+        INSERT OR IGNORE INTO taxon_photo_counts (taxon_id) VALUES (NEW.taxon_id);
+        UPDATE taxon_photo_counts SET direct_count = direct_count + 1 WHERE taxon_id = NEW.taxon_id;
+        UPDATE taxon_photo_counts SET subtree_count = subtree_count + 1 WHERE taxon_id IN (
+            WITH RECURSIVE lineage(taxon_id) AS (
+                SELECT NEW.taxon_id
+                UNION
+                SELECT taxon_photo_counts.parent_id
+                FROM taxon_photo_counts
+                JOIN lineage ON taxon_photo_counts.taxon_id = lineage.taxon_id
+            )
+            SELECT taxon_id FROM lineage
+        );
+    END
+    ''')
+    connection.execute('''
+    CREATE TRIGGER IF NOT EXISTS photos_count_delete AFTER DELETE ON photos
+    BEGIN
+        UPDATE taxon_photo_counts SET direct_count = direct_count - 1 WHERE taxon_id = OLD.taxon_id;
+        UPDATE taxon_photo_counts SET subtree_count = subtree_count - 1 WHERE taxon_id IN (
+            WITH RECURSIVE lineage(taxon_id) AS (
+                SELECT OLD.taxon_id
+                UNION
+                SELECT taxon_photo_counts.parent_id
+                FROM taxon_photo_counts
+                JOIN lineage ON taxon_photo_counts.taxon_id = lineage.taxon_id
+            )
+            SELECT taxon_id FROM lineage
+        );
+    END
+    ''')
+
+    # Databases created before the counts existed start with direct counts only;
+    # record_photo_taxa fills in their lineage and subtree counts later
+    if not counts_exist:
+        connection.execute('''
+        INSERT INTO taxon_photo_counts (taxon_id, direct_count, subtree_count)
+        SELECT taxon_id, COUNT(*), COUNT(*) FROM photos GROUP BY taxon_id
+        ''')
+
+def rebuild_photo_counts(connection):
+    # Recomputes every count from photos and the recorded lineage
+    connection.execute("UPDATE taxon_photo_counts SET direct_count = 0, subtree_count = 0")
+    connection.execute('''
+        INSERT INTO taxon_photo_counts (taxon_id, direct_count)
+        SELECT taxon_id, COUNT(*) FROM photos WHERE true GROUP BY taxon_id
+        ON CONFLICT(taxon_id) DO UPDATE SET direct_count = excluded.direct_count
+        ''')
+    subtree_counts = connection.execute('''
+        WITH RECURSIVE lineage(taxon_id, photo_count) AS (
+            SELECT taxon_id, direct_count FROM taxon_photo_counts WHERE direct_count > 0
+            UNION ALL
+            SELECT taxon_photo_counts.parent_id, lineage.photo_count
+            FROM taxon_photo_counts
+            JOIN lineage ON taxon_photo_counts.taxon_id = lineage.taxon_id
+        )
+        SELECT SUM(photo_count), taxon_id FROM lineage GROUP BY taxon_id
+        ''').fetchall()
+    connection.executemany("UPDATE taxon_photo_counts SET subtree_count = ? WHERE taxon_id = ?", subtree_counts)
+
+def forget_taxon_lineage(connection, taxon_ids):
+    # For taxa moved or removed by a taxonomy update: their lineage is looked up again by the next
+    # record_photo_taxa, which then recounts the subtrees
+    connection.executemany("UPDATE taxon_photo_counts SET parent_id = NULL WHERE taxon_id = ?",
+                           ((taxon_id,) for taxon_id in taxon_ids))
+
+def record_photo_taxa(connection, taxonomy_database_path, taxon_ids=None):
+    # Records where photographed taxa sit in the taxonomy, so the count triggers can carry each
+    # photo up to the root. Must run before their photos are inserted. Taxa already recorded are
+    # skipped; taxon_ids=None records every taxon whose lineage is still missing.
+    if taxon_ids is None:
+        new_taxon_ids = {row[0] for row in connection.execute(
+            "SELECT taxon_id FROM taxon_photo_counts WHERE parent_id IS NULL")}
+    else:
+        # Only the given ids are looked up, not every taxon already recorded
+        cursor = connection.cursor()
+        load_taxon_id_table(cursor, "record_taxon_ids", taxon_ids)
+        new_taxon_ids = {row[0] for row in cursor.execute('''
+            SELECT record_taxon_ids.taxon_id
+            FROM temp.record_taxon_ids
+            LEFT JOIN taxon_photo_counts ON taxon_photo_counts.taxon_id = record_taxon_ids.taxon_id
+            WHERE taxon_photo_counts.parent_id IS NULL
+            ''')}
+    # Opening a missing taxonomy would create an empty file in its place
+    if not new_taxon_ids or not os.path.exists(taxonomy_database_path):
+        return
+
+    lineage_rows = get_taxon_lineage(get_database(taxonomy_database_path).reader().cursor(), new_taxon_ids)
+    # Taxa missing from the taxonomy count as roots of their own
+    found_taxon_ids = {taxon_id for taxon_id, _ in lineage_rows}
+    lineage_rows.extend((taxon_id, '') for taxon_id in new_taxon_ids - found_taxon_ids)
+
+    counted_without_lineage = connection.execute(
+        "SELECT 1 FROM taxon_photo_counts WHERE parent_id IS NULL AND subtree_count > 0 LIMIT 1").fetchone()
+    connection.executemany('''
+        INSERT INTO taxon_photo_counts (taxon_id, parent_id) VALUES (?, ?)
+        ON CONFLICT(taxon_id) DO UPDATE SET parent_id = excluded.parent_id WHERE parent_id IS NULL
+        ''', lineage_rows)
+    # Photos counted before their lineage was known haven't reached their ancestors yet
+    if counted_without_lineage is not None:
+        rebuild_photo_counts(connection)
+
+def open_photo_database(database_path):
+    # Shared Database for a photo database, with its schema created or upgraded on first use
+    database = get_database(database_path)
+    with checked_databases_lock:
+        if database.database_path not in checked_databases:
+            with database.transaction() as connection:
+                create_photos_schema(connection)
+            checked_databases.add(database.database_path)
+    return database
+
+def create_photo_database(database_name):
+    os.makedirs(os.path.join(base_dir, 'databases'), exist_ok=True)
+    open_photo_database(get_photo_database_path(database_name))
+
+def hash_file(file_path):
+    content_hash = hashlib.sha256()
+    with open(file_path, "rb") as photo_file:
+        for chunk in iter(lambda: photo_file.read(1024 * 1024), b""):
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+def get_content_path(photo_folder_path, content_hash, extension):
+    # Sharded by the first hash bytes so no single directory grows huge
+    return os.path.join(photo_folder_path, content_hash[:2], content_hash[2:4], content_hash + extension.lower())
+
+def find_stored_content(photo_folder_path, content_hash):
+    # Path the content is already stored under, whatever extension it came with, or None
+    shard_path = os.path.dirname(get_content_path(photo_folder_path, content_hash, ""))
+    try:
+        file_names = os.listdir(shard_path)
+    except FileNotFoundError:
+        return None
+    for file_name in sorted(file_names):
+        stem, extension = os.path.splitext(file_name)
+        if stem == content_hash and extension != ".part":
+            return os.path.join(shard_path, file_name)
+    return None
+
+def clone_file(source_path, destination_path):
+    # Reflink, then hardlink, then a plain copy, whichever the filesystem allows first
+    if fcntl is not None:
+        try:
+            with open(source_path, "rb") as source, open(destination_path, "wb") as destination:
+                fcntl.ioctl(destination.fileno(), ficlone_request, source.fileno())
+            return
+        except OSError:
+            pass
+    try:
+        if os.path.exists(destination_path):
+            os.remove(destination_path)
+        os.link(source_path, destination_path)
+        return
+    except OSError:
+        pass
+    shutil.copy2(source_path, destination_path)
+
+def store_photo(source_path, photo_folder_path):
+    # Stores a photo under its content hash; identical content is only ever stored once.
+    # Returns (photo_path, content_hash, byte_size, mtime).
+    content_hash = hash_file(source_path)
+    stat = os.stat(source_path)
+    # The same bytes uploaded as x.jpg and x.jpeg share the first file stored
+    photo_path = find_stored_content(photo_folder_path, content_hash)
+    if photo_path is None:
+        photo_path = get_content_path(photo_folder_path, content_hash, os.path.splitext(source_path)[1])
+
+    if not os.path.exists(photo_path):
+        os.makedirs(os.path.dirname(photo_path), exist_ok=True)
+        # Written under a temporary name first, so an interrupted store never leaves a half-written photo
+        temporary_path = f"{photo_path}.{threading.get_ident()}.part"
+        clone_file(source_path, temporary_path)
+        os.replace(temporary_path, photo_path)
+
+    return photo_path, content_hash, stat.st_size, stat.st_mtime
+
+def insert_photos(connection, photo_rows):
+    # photo_rows of (taxon_id, photo_path, content_hash, byte_size, mtime). The same content
+    # is recorded once per taxon, so re-adding a photo is a no-op. Returns the number inserted.
+    # Call record_photo_taxa first, so the new photos are counted for every ancestor.
+    cursor = connection.executemany('''
+        INSERT INTO photos (taxon_id, filepath, content_hash, byte_size, mtime)
+        SELECT ?1, ?2, ?3, ?4, ?5
+        WHERE NOT EXISTS (SELECT 1 FROM photos WHERE content_hash = ?3 AND taxon_id = ?1)
+        ''', photo_rows)
+    # rowcount rather than total_changes, which also counts the rows the count triggers touch
+    return cursor.rowcount
+
+def insert_photo_metadata(connection, metadata_rows):
+    # metadata_rows of (content_hash, PhotoMetadata); content already described is left as it is
+    connection.executemany('''
+        INSERT OR IGNORE INTO photo_metadata (content_hash, width, height, captured_at, orientation, camera)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ''', ((content_hash, metadata.width, metadata.height, metadata.captured_at, metadata.orientation,
+               metadata.camera) for content_hash, metadata in metadata_rows))
+
+def get_cameras(cursor, taxon_ids):
+    # Cameras that took any of the photos of taxon_ids, for filtering an album
+    load_taxon_id_table(cursor, "camera_taxon_ids", taxon_ids)
+    cursor.execute('''
+        SELECT DISTINCT photo_metadata.camera
+        FROM photos
+        JOIN temp.camera_taxon_ids ON camera_taxon_ids.taxon_id = photos.taxon_id
+        JOIN photo_metadata ON photo_metadata.content_hash = photos.content_hash
+        WHERE photo_metadata.camera IS NOT NULL
+        ORDER BY photo_metadata.camera
+        ''')
+    return [row[0] for row in cursor.fetchall()]
+
+def add_photo(database_path, taxon_id, source_path, photo_folder_path,
+              taxonomy_database_path=default_taxonomy_database_path):
+    photo_path, content_hash, byte_size, mtime = store_photo(source_path, photo_folder_path)
+    metadata = read_photo_metadata(photo_path)
+    with open_photo_database(database_path).transaction() as connection:
+        record_photo_taxa(connection, taxonomy_database_path, [taxon_id])
+        insert_photos(connection, [(taxon_id, photo_path, content_hash, byte_size, mtime)])
+        insert_photo_metadata(connection, [(content_hash, metadata)])
+        row = connection.execute(
+            "SELECT photo_id FROM photos WHERE content_hash = ? AND taxon_id = ?",
+            (content_hash, taxon_id)
+        ).fetchone()
+    return row[0]
+
+def delete_photo(database_path, photo_id):
+    # Returns the taxon the photo belonged to, or None if there was no such photo
+    with open_photo_database(database_path).transaction() as connection:
+        row = connection.execute(
+            "SELECT taxon_id, filepath, content_hash FROM photos WHERE photo_id = ?", (photo_id,)).fetchone()
+        if row is None:
+            return None
+        taxon_id, photo_path, content_hash = row
+        connection.execute("DELETE FROM photos WHERE photo_id = ?", (photo_id,))
+        # Older stores may hold the same content under two file names, so the file and the
+        # metadata are checked separately
+        file_referenced = connection.execute(
+            "SELECT 1 FROM photos WHERE filepath = ? LIMIT 1", (photo_path,)).fetchone() is not None
+        content_referenced = content_hash is None or connection.execute(
+            "SELECT 1 FROM photos WHERE content_hash = ? LIMIT 1", (content_hash,)).fetchone() is not None
+        if not content_referenced:
+            connection.execute("DELETE FROM photo_metadata WHERE content_hash = ?", (content_hash,))
+
+    # Stored content goes once the last row pointing at its file is gone
+    if not file_referenced:
+        try:
+            os.remove(photo_path)
+        except FileNotFoundError:
+            pass
+    return taxon_id
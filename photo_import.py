@@ -0,0 +1,168 @@
+import os
+import re
+import sys
+import csv
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from database import get_database, close_all_databases
+from photo_database import (open_photo_database, get_photo_database_path, get_photo_folder_path,
+                            store_photo, insert_photos, insert_photo_metadata, record_photo_taxa)
+from photo_metadata import read_photo_metadata
+from taxon_search import find_taxon_ids
+
+photo_extensions = {".png", ".jpg", ".jpeg", ".bmp", ".gif"}
+# Photo rows inserted per transaction
+default_import_batch_size = 200
+default_import_workers = 8
+
+# "Nymphalis io 2.jpg" -> "Nymphalis io"
+trailing_number_regex = re.compile(r'[\s_\-]*\d+$')
+
+def find_photos(directory):
+    for folder, _, file_names in os.walk(directory):
+        for file_name in sorted(file_names):
+            if os.path.splitext(file_name)[1].lower() in photo_extensions:
+                yield os.path.join(folder, file_name)
+
+def taxon_from_folder(photo_path):
+    return os.path.basename(os.path.dirname(photo_path))
+
+def taxon_from_prefix(photo_path):
+    stem = os.path.splitext(os.path.basename(photo_path))[0]
+    return trailing_number_regex.sub("", stem).replace("_", " ").strip()
+
+def get_mapping_key(photo_path):
+    # Paths relative to the imported directory, so equal file names in different folders don't collide
+    return os.path.normcase(os.path.normpath(photo_path))
+
+def read_taxon_mapping(csv_path):
+    # CSV rows of: file path relative to the imported directory, taxon name or taxon id
+    taxon_mapping = {}
+    with open(csv_path, newline="") as csv_file:
+        for row in csv.reader(csv_file):
+            if len(row) < 2 or not row[0].strip():
+                continue
+            taxon_mapping[get_mapping_key(row[0].strip())] = row[1].strip()
+    return taxon_mapping
+
+class TaxonResolver:
+    # Maps taxon names (or ids written as digits) to taxon ids, caching each lookup
+    def __init__(self, taxonomy_database_path):
+        self.taxonomy_cursor = get_database(taxonomy_database_path).reader().cursor()
+        self.taxon_ids = {}
+
+    def resolve(self, taxon, allow_id=False):
+        # Ids are only taken from a CSV mapping; a folder or file named "2024" is a name, not an id
+        if allow_id and taxon.isdigit():
+            self.taxonomy_cursor.execute("SELECT 1 FROM taxons WHERE taxon_id = ?", (int(taxon),))
+            return int(taxon) if self.taxonomy_cursor.fetchone() is not None else None
+        if taxon not in self.taxon_ids:
+            taxon_ids = find_taxon_ids(self.taxonomy_cursor, taxon)
+            # Unknown names and homonyms can't be imported unambiguously
+            self.taxon_ids[taxon] = taxon_ids[0] if len(taxon_ids) == 1 else None
+        return self.taxon_ids[taxon]
+
+def store_and_describe_photo(source_path, photo_folder_path):
+    # Runs on the worker threads: copy the photo in, then read its headers while the file is warm
+    stored = store_photo(source_path, photo_folder_path)
+    return stored, read_photo_metadata(stored[0])
+
+def insert_photo_rows(database, photo_rows, metadata_rows, taxonomy_database_path):
+    with database.transaction() as connection:
+        record_photo_taxa(connection, taxonomy_database_path, {photo_row[0] for photo_row in photo_rows})
+        insert_photo_metadata(connection, metadata_rows)
+        return insert_photos(connection, photo_rows)
+
+def print_progress(done, total):
+    print(f"\rImported {done}/{total}", end="" if done < total else "\n", flush=True)
+
+def import_photos(database_name, directory, taxonomy_database_path, mapping="folder", csv_path=None,
+                  workers=default_import_workers, batch_size=default_import_batch_size, progress=print_progress):
+    # Returns a dict of counts plus the set of taxon ids that received photos
+    database = open_photo_database(get_photo_database_path(database_name))
+    photo_folder_path = get_photo_folder_path(database_name)
+    os.makedirs(photo_folder_path, exist_ok=True)
+
+    resolver = TaxonResolver(taxonomy_database_path)
+    taxon_mapping = read_taxon_mapping(csv_path) if mapping == "csv" else None
+
+    result = {"imported": 0, "skipped": 0, "unmatched": [], "failed": [], "taxon_ids": set()}
+
+    pending = []
+    for source_path in find_photos(directory):
+        if mapping == "folder":
+            taxon = taxon_from_folder(source_path)
+        elif mapping == "prefix":
+            taxon = taxon_from_prefix(source_path)
+        else:
+            taxon = taxon_mapping.get(get_mapping_key(os.path.relpath(source_path, directory)), "")
+        taxon_id = resolver.resolve(taxon, allow_id=mapping == "csv") if taxon else None
+        if taxon_id is None:
+            result["unmatched"].append(source_path)
+            continue
+        pending.append((source_path, taxon_id))
+
+    # Content already stored isn't copied again and rows already recorded aren't inserted again,
+    # so an interrupted import resumes by simply being rerun
+    photo_rows = []
+    metadata_rows = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(store_and_describe_photo, source_path, photo_folder_path): (source_path, taxon_id)
+                   for source_path, taxon_id in pending}
+        for done, future in enumerate(as_completed(futures), 1):
+            source_path, taxon_id = futures[future]
+            try:
+                (photo_path, content_hash, byte_size, mtime), metadata = future.result()
+            except OSError as error:
+                result["failed"].append((source_path, str(error)))
+            else:
+                photo_rows.append((taxon_id, photo_path, content_hash, byte_size, mtime))
+                metadata_rows.append((content_hash, metadata))
+                result["taxon_ids"].add(taxon_id)
+            if len(photo_rows) >= batch_size:
+                result["imported"] += insert_photo_rows(database, photo_rows, metadata_rows, taxonomy_database_path)
+                photo_rows = []
+                metadata_rows = []
+            if progress is not None:
+                progress(done, len(pending))
+    if photo_rows:
+        result["imported"] += insert_photo_rows(database, photo_rows, metadata_rows, taxonomy_database_path)
+    result["skipped"] = len(pending) - len(result["failed"]) - result["imported"]
+
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import a directory of photos into a photo database")
+    parser.add_argument("database_name", help="photo database, as in databases/<name>.db")
+    parser.add_argument("directory")
+    parser.add_argument("--mapping", choices=["folder", "prefix", "csv"], default="folder",
+                        help="take the taxon from the parent folder name, the file name, or a CSV file")
+    parser.add_argument("--csv", dest="csv_path", help="CSV of file path relative to the directory, taxon name or id (with --mapping csv)")
+    parser.add_argument("--taxonomy", default=None, help="path of taxonomy.db")
+    parser.add_argument("--workers", type=int, default=default_import_workers)
+    parser.add_argument("--batch-size", type=int, default=default_import_batch_size)
+    args = parser.parse_args(argv)
+
+    if args.mapping == "csv" and not args.csv_path:
+        parser.error("--mapping csv needs --csv")
+
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    taxonomy_database_path = args.taxonomy or os.path.join(base_dir, 'taxonomy.db')
+
+    start_time = time.perf_counter()
+    result = import_photos(args.database_name, args.directory, taxonomy_database_path, args.mapping,
+                           args.csv_path, args.workers, args.batch_size)
+    elapsed = time.perf_counter() - start_time
+    close_all_databases()
+
+    print(f"Imported {result['imported']} photos in {elapsed:.2f} s, "
+          f"skipped {result['skipped']} already in the database")
+    for source_path in result["unmatched"]:
+        print(f"No unique taxon for {source_path}")
+    for source_path, error in result["failed"]:
+        print(f"Failed to copy {source_path}: {error}")
+    return 1 if result["failed"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,119 @@
+# Reads a photo's size and EXIF fields from its file headers, without decoding any pixels.
+# Headless on purpose, so bulk imports can run it on worker threads without Qt.
+
+import struct
+
+# EXIF tags read from a photo
+exif_make_tag = 0x010F
+exif_model_tag = 0x0110
+exif_orientation_tag = 0x0112
+exif_date_time_tag = 0x0132
+exif_ifd_pointer_tag = 0x8769
+exif_date_time_original_tag = 0x9003
+
+# EXIF field types: byte size of one value
+exif_type_sizes = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 9: 4, 10: 8}
+
+# JPEG start-of-frame markers, the segments that carry the image size (C4, C8 and CC are other tables)
+jpeg_frame_markers = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+jpeg_start_of_scan = 0xDA
+
+class PhotoMetadata:
+    __slots__ = ("width", "height", "captured_at", "orientation", "camera")
+
+    def __init__(self, width=None, height=None, captured_at=None, orientation=None, camera=None):
+        self.width = width
+        self.height = height
+        self.captured_at = captured_at  # "YYYY-MM-DD HH:MM:SS", so it sorts as text
+        self.orientation = orientation  # EXIF orientation, 1-8
+        self.camera = camera
+
+def read_photo_metadata(photo_path):
+    # Fields that can't be read are left as None; a damaged header never raises
+    metadata = PhotoMetadata()
+    try:
+        with open(photo_path, "rb") as photo_file:
+            header = photo_file.read(32)
+            if header.startswith(b"\xff\xd8"):
+                photo_file.seek(2)
+                read_jpeg_metadata(photo_file, metadata)
+            elif header.startswith(b"\x89PNG\r\n\x1a\n"):
+                metadata.width, metadata.height = struct.unpack(">II", header[16:24])
+            elif header[:6] in (b"GIF87a", b"GIF89a"):
+                metadata.width, metadata.height = struct.unpack("<HH", header[6:10])
+            elif header.startswith(b"BM"):
+                width, height = struct.unpack("<ii", header[18:26])
+                # Negative heights mark top-down bitmaps
+                metadata.width, metadata.height = width, abs(height)
+    except (OSError, struct.error, ValueError, IndexError):
+        pass
+    return metadata
+
+def read_jpeg_metadata(photo_file, metadata):
+    # Walks the segments up to the compressed data: APP1 holds EXIF, a start-of-frame the size
+    while True:
+        marker_start = photo_file.read(1)
+        if marker_start != b"\xff":
+            return
+        marker = photo_file.read(1)
+        # Fill bytes before a marker
+        while marker == b"\xff":
+            marker = photo_file.read(1)
+        if not marker or marker[0] == jpeg_start_of_scan:
+            return
+        segment_length = struct.unpack(">H", photo_file.read(2))[0]
+        segment = photo_file.read(segment_length - 2)
+
+        if marker[0] == 0xE1 and segment.startswith(b"Exif\x00\x00"):
+            read_exif(segment[6:], metadata)
+        elif marker[0] in jpeg_frame_markers:
+            metadata.height, metadata.width = struct.unpack(">HH", segment[1:5])
+            return
+
+def read_exif(tiff, metadata):
+    byte_order = "<" if tiff[:2] == b"II" else ">"
+    first_ifd_offset = struct.unpack(byte_order + "I", tiff[4:8])[0]
+
+    fields = read_exif_ifd(tiff, byte_order, first_ifd_offset)
+    if exif_ifd_pointer_tag in fields:
+        fields.update(read_exif_ifd(tiff, byte_order, fields[exif_ifd_pointer_tag]))
+
+    orientation = fields.get(exif_orientation_tag)
+    if isinstance(orientation, int) and 1 <= orientation <= 8:
+        metadata.orientation = orientation
+
+    # "2023:06:14 10:31:02" -> "2023-06-14 10:31:02"
+    captured_at = fields.get(exif_date_time_original_tag) or fields.get(exif_date_time_tag)
+    if isinstance(captured_at, str) and len(captured_at) >= 19 and captured_at[:4].isdigit():
+        metadata.captured_at = captured_at[:4] + "-" + captured_at[5:7] + "-" + captured_at[8:10] + captured_at[10:19]
+
+    make = fields.get(exif_make_tag)
+    model = fields.get(exif_model_tag)
+    make = make if isinstance(make, str) else ""
+    model = model if isinstance(model, str) else ""
+    # Many models already start with the make, "Canon EOS 90D"
+    camera = model if model.lower().startswith(make.lower()) else f"{make} {model}"
+    metadata.camera = camera.strip() or None
+
+def read_exif_ifd(tiff, byte_order, ifd_offset):
+    # tag -> value for the ASCII, SHORT and LONG entries of one image file directory
+    fields = {}
+    entry_count = struct.unpack(byte_order + "H", tiff[ifd_offset:ifd_offset + 2])[0]
+    for entry in range(entry_count):
+        entry_offset = ifd_offset + 2 + entry * 12
+        tag, field_type, value_count = struct.unpack(byte_order + "HHI", tiff[entry_offset:entry_offset + 8])
+        value_size = exif_type_sizes.get(field_type, 1) * value_count
+        # Values of up to four bytes are stored in the entry itself, longer ones at an offset
+        if value_size <= 4:
+            value_bytes = tiff[entry_offset + 8:entry_offset + 8 + value_size]
+        else:
+            value_offset = struct.unpack(byte_order + "I", tiff[entry_offset + 8:entry_offset + 12])[0]
+            value_bytes = tiff[value_offset:value_offset + value_size]
+
+        if field_type == 2:
+            fields[tag] = value_bytes.split(b"\x00", 1)[0].decode("ascii", "replace").strip()
+        elif field_type == 3 and value_count >= 1:
+            fields[tag] = struct.unpack(byte_order + "H", value_bytes[:2])[0]
+        elif field_type == 4 and value_count >= 1:
+            fields[tag] = struct.unpack(byte_order + "I", value_bytes[:4])[0]
+    return fields
@@ -0,0 +1,68 @@
+# Completions returned per query
+search_result_limit = 50
+# The trigram tokenizer can't match anything shorter than this
+minimum_trigram_length = 3
+
+def create_taxon_search_index(cursor):
+    # Trigram FTS5 index over taxon names, kept as an external-content table on taxons
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS taxons_search USING fts5(
+            taxon_name, content='taxons', content_rowid='taxon_id', tokenize='trigram'
+        )
+        ''')
+    cursor.execute("INSERT INTO taxons_search(taxons_search) VALUES('rebuild')")
+
+def delete_taxon_search_entries(cursor, taxon_rows):
+    # taxon_rows of (taxon_id, taxon_name) as currently stored; an external-content index
+    # needs the old values to remove them, so this runs before taxons itself changes
+    cursor.executemany(
+        "INSERT INTO taxons_search(taxons_search, rowid, taxon_name) VALUES('delete', ?, ?)", taxon_rows)
+
+def insert_taxon_search_entries(cursor, taxon_rows):
+    cursor.executemany("INSERT INTO taxons_search(rowid, taxon_name) VALUES(?, ?)", taxon_rows)
+
+def has_taxon_search_index(cursor):
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'taxons_search'")
+    return cursor.fetchone() is not None
+
+def escape_like(text):
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def search_taxons(cursor, text, limit=search_result_limit, use_index=True):
+    # Returns (taxon_id, taxon_name, taxon_rank) rows whose name contains text, closest matches first
+    text = text.strip()
+    if not text:
+        return []
+
+    if use_index and len(text) >= minimum_trigram_length:
+        cursor.execute('''
+            SELECT taxons.taxon_id, taxons.taxon_name, taxons.taxon_rank
+            FROM taxons_search
+            JOIN taxons ON taxons.taxon_id = taxons_search.rowid
+            WHERE taxons_search MATCH ?
+            ORDER BY instr(lower(taxons.taxon_name), lower(?)), length(taxons.taxon_name)
+            LIMIT ?
+            ''', ('"' + text.replace('"', '""') + '"', text, limit))
+    elif use_index:
+        # Too short for trigrams: prefix match on the NOCASE name index instead
+        cursor.execute('''
+            SELECT taxon_id, taxon_name, taxon_rank
+            FROM taxons
+            WHERE taxon_name LIKE ? ESCAPE '\\'
+            LIMIT ?
+            ''', (escape_like(text) + "%", limit))
+    else:
+        # Taxonomy built without the search index: bounded substring scan
+        cursor.execute('''
+            SELECT taxon_id, taxon_name, taxon_rank
+            FROM taxons
+            WHERE taxon_name LIKE ? ESCAPE '\\'
+            LIMIT ?
+            ''', ("%" + escape_like(text) + "%", limit))
+    return cursor.fetchall()
+
+def find_taxon_ids(cursor, taxon_name):
+    # All taxa with exactly this name (case-insensitive); homonyms give more than one id
+    cursor.execute("SELECT taxon_id FROM taxons WHERE taxon_name LIKE ? ESCAPE '\\'",
+                   (escape_like(taxon_name.strip()),))
+    return [row[0] for row in cursor.fetchall()]
@@ -0,0 +1,159 @@
+# Builds the tree of photographed taxa and their ancestors from the photo and taxonomy databases
+
+from instrumentation import timed
+
+def get_taxonomy_version(cursor):
+    # Latest import recorded in taxonomy_versions; 0 for a taxonomy built before versions were kept
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'taxonomy_versions'")
+    if cursor.fetchone() is None:
+        return 0
+    cursor.execute("SELECT MAX(version) FROM taxonomy_versions")
+    return cursor.fetchone()[0] or 0
+
+def get_taxonomy_stamp(cursor):
+    # Latest version with its import time, which also tells apart a taxonomy rebuilt from scratch
+    version = get_taxonomy_version(cursor)
+    if version == 0:
+        return "0"
+    cursor.execute("SELECT imported_at FROM taxonomy_versions WHERE version = ?", (version,))
+    return f"{version}:{cursor.fetchone()[0]}"
+
+@timed()
+def get_entries_with_photos(cursor):
+    # Read from the per-taxon counts rather than scanning photos
+    cursor.execute("SELECT taxon_id FROM taxon_photo_counts WHERE direct_count > 0")
+    rows = cursor.fetchall()
+    entries_with_photos = set()
+    for row in rows:
+        taxon_id = row[0]
+        entries_with_photos.add(taxon_id)
+    return entries_with_photos
+
+@timed()
+def get_photo_counts(cursor, taxon_ids=None):
+    # taxon_id -> (photos of the taxon itself, photos in its whole subtree), for taxa with any photos
+    if taxon_ids is None:
+        cursor.execute("SELECT taxon_id, direct_count, subtree_count FROM taxon_photo_counts WHERE subtree_count > 0")
+    else:
+        load_taxon_id_table(cursor, "count_taxon_ids", taxon_ids)
+        cursor.execute('''SELECT taxon_photo_counts.taxon_id, direct_count, subtree_count
+                          FROM taxon_photo_counts
+                          JOIN temp.count_taxon_ids ON taxon_photo_counts.taxon_id = count_taxon_ids.taxon_id
+                       ''')
+    return {taxon_id: (direct_count, subtree_count) for taxon_id, direct_count, subtree_count in cursor.fetchall()}
+
+@timed()
+def get_direct_photo_counts(cursor):
+    # For a photo database from before taxon_photo_counts that can't be migrated: every photographed
+    # taxon with its own photos as its subtree count, as the migration starts them
+    cursor.execute("SELECT taxon_id, COUNT(*) FROM photos GROUP BY taxon_id")
+    return {taxon_id: (photo_count, photo_count) for taxon_id, photo_count in cursor.fetchall()}
+
+def load_taxon_id_table(cursor, table_name, taxon_ids):
+    # Temporary id tables stand in for IN (?, ?, ...) lists, which break past SQLite's bound-parameter limit
+    cursor.execute(f"CREATE TEMP TABLE IF NOT EXISTS {table_name} (taxon_id INTEGER PRIMARY KEY)")
+    cursor.execute(f"DELETE FROM temp.{table_name}")
+    cursor.executemany(
+        f"INSERT OR IGNORE INTO temp.{table_name} (taxon_id) VALUES (?)",
+        ((taxon_id,) for taxon_id in taxon_ids)
+    )
+
+def get_taxon_lineage(cursor, taxon_ids):
+    load_taxon_id_table(cursor, "photo_taxon_ids", taxon_ids)
+
+    # Walks up the whole lineage of every given taxon in one query, returning (taxon_id, parent_id) rows.
+    # Taxon ids missing from taxons are dropped instead of breaking the walk.
+    cursor.execute('''
+        WITH RECURSIVE ancestors(taxon_id, parent_id) AS (
+            SELECT taxon_id, parent_id
+            FROM taxons
+            WHERE taxon_id IN (SELECT taxon_id FROM temp.photo_taxon_ids)
+            UNION
+            SELECT taxons.taxon_id, taxons.parent_id
+            FROM taxons
+            JOIN ancestors ON taxons.taxon_id = ancestors.parent_id
+        )
+        SELECT taxon_id, parent_id FROM ancestors
+    ''')
+    return cursor.fetchall()
+
+@timed()
+def get_entry_ancestors(cursor, photo_taxonomy):
+    taxonomy_ids = {taxon_id for taxon_id, _ in get_taxon_lineage(cursor, photo_taxonomy)}
+
+    return taxonomy_ids
+
+@timed()
+def get_subtree_photo_taxa(taxonomy_cursor, photos_cursor, taxon_id):
+    # Photographed taxa in taxon_id's subtree, itself included, in depth-first order so an album
+    # of the subtree is grouped taxonomically
+    load_taxon_id_table(taxonomy_cursor, "album_taxon_ids", get_entries_with_photos(photos_cursor))
+    interval = taxonomy_cursor.execute(
+        "SELECT interval_start, interval_end FROM taxons WHERE taxon_id = ?", (taxon_id,)).fetchone()
+    if interval is not None and interval[0] is not None:
+        taxonomy_cursor.execute('''SELECT taxons.taxon_id
+                                  FROM taxons
+                                  JOIN temp.album_taxon_ids ON taxons.taxon_id = album_taxon_ids.taxon_id
+                                  WHERE interval_start BETWEEN ? AND ?
+                                  ORDER BY interval_start
+                               ''', interval)
+        return [row[0] for row in taxonomy_cursor.fetchall()]
+
+    # Taxonomy built before interval numbering, or a taxon missing from it: walk down the parent links
+    taxonomy_cursor.execute('''
+        WITH RECURSIVE subtree(taxon_id) AS (
+            SELECT ?
+            UNION
+            SELECT taxons.taxon_id
+            FROM taxons
+            JOIN subtree ON taxons.parent_id = subtree.taxon_id
+        )
+        SELECT subtree.taxon_id
+        FROM subtree
+        JOIN temp.album_taxon_ids ON subtree.taxon_id = album_taxon_ids.taxon_id
+    ''', (taxon_id,))
+    return [row[0] for row in taxonomy_cursor.fetchall()]
+
+class TaxonNode:
+    __slots__ = ("id", "taxon_name", "taxon_rank", "has_photos", "photo_count", "subtree_photo_count", "children")
+
+    def __init__(self, taxon_id, taxon_name, taxon_rank, has_photos, photo_count=0, subtree_photo_count=0):
+        self.id = taxon_id
+        self.taxon_name = taxon_name
+        self.taxon_rank = taxon_rank
+        self.has_photos = has_photos
+        self.photo_count = photo_count
+        self.subtree_photo_count = subtree_photo_count
+        self.children = []
+
+@timed()
+def build_taxon_tree(taxonomy_cursor, taxonomy_to_render, entries_with_photos, photo_counts=None):
+
+    if not taxonomy_to_render:
+        return []
+
+    load_taxon_id_table(taxonomy_cursor, "render_taxon_ids", taxonomy_to_render)
+    taxonomy_cursor.execute('''SELECT taxons.taxon_id, taxon_name, taxon_rank, parent_id
+                                FROM taxons
+                                JOIN temp.render_taxon_ids ON taxons.taxon_id = render_taxon_ids.taxon_id
+                                ORDER BY taxons.taxon_id
+                             ''')
+
+    taxonomy_rows = taxonomy_cursor.fetchall()
+    nodes_id = {}
+    photo_counts = photo_counts or {}
+
+    for taxon_id, taxon_name, taxon_rank, parent_id in taxonomy_rows:
+        photo_count, subtree_photo_count = photo_counts.get(taxon_id, (0, 0))
+        nodes_id[taxon_id] = TaxonNode(taxon_id, taxon_name, taxon_rank, taxon_id in entries_with_photos,
+                                       photo_count, subtree_photo_count)
+
+    # Parents are looked up in nodes_id, so a taxon whose parent isn't rendered becomes a root
+    roots = []
+    for taxon_id, _, _, parent_id in taxonomy_rows:
+        parent = nodes_id.get(parent_id)
+        if parent is not None:
+            parent.children.append(nodes_id[taxon_id])
+        else:
+            roots.append(nodes_id[taxon_id])
+    return roots
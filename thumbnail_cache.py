@@ -0,0 +1,152 @@
+import os
+import hashlib
+import threading
+from PyQt6.QtGui import QImage, QImageReader
+from PyQt6.QtCore import Qt
+from instrumentation import span, count
+
+# Thumbnail edge lengths in pixels, smallest first
+thumbnail_sizes = (128, 256, 512)
+default_max_cache_bytes = 256 * 1024 * 1024
+
+thumbnail_caches = {}
+thumbnail_caches_lock = threading.Lock()
+
+def get_thumbnail_cache_dir(photo_database_path):
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    database_name = os.path.splitext(os.path.basename(photo_database_path))[0]
+    return os.path.join(base_dir, 'images', database_name, '.thumbnails')
+
+def get_thumbnail_cache(cache_dir):
+    # One shared ThumbnailCache per directory, so its files are scanned once and all albums of a
+    # gallery count against the same budget
+    cache_dir = os.path.abspath(cache_dir)
+    with thumbnail_caches_lock:
+        thumbnail_cache = thumbnail_caches.get(cache_dir)
+        if thumbnail_cache is None:
+            thumbnail_cache = ThumbnailCache(cache_dir)
+            thumbnail_caches[cache_dir] = thumbnail_cache
+        return thumbnail_cache
+
+def get_thumbnail_size(requested_size):
+    # Smallest tier that still covers the requested edge length
+    for size in thumbnail_sizes:
+        if size >= requested_size:
+            return size
+    return thumbnail_sizes[-1]
+
+class ThumbnailCache:
+    def __init__(self, cache_dir, max_bytes=default_max_cache_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        # thumbnail path -> [byte size, last access time]
+        self.entries = {}
+        self.total_bytes = 0
+
+        for size in thumbnail_sizes:
+            tier_dir = os.path.join(cache_dir, str(size))
+            os.makedirs(tier_dir, exist_ok=True)
+            for entry in os.scandir(tier_dir):
+                if entry.is_file() and entry.name.endswith(".part"):
+                    # Left behind by a save that never finished
+                    os.remove(entry.path)
+                elif entry.is_file():
+                    stat = entry.stat()
+                    self.entries[entry.path] = [stat.st_size, stat.st_mtime]
+                    self.total_bytes += stat.st_size
+
+    def get_thumbnail_path(self, photo_path, size, content_hash=None):
+        # Content-addressed photos are keyed by their hash directly; anything else on
+        # path plus mtime/size, so an edited photo gets a fresh thumbnail
+        if content_hash is not None:
+            return os.path.join(self.cache_dir, str(size), content_hash + ".jpg")
+        stat = os.stat(photo_path)
+        key = f"{os.path.abspath(photo_path)}:{stat.st_mtime_ns}:{stat.st_size}"
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, str(size), digest + ".jpg")
+
+    def get_thumbnail(self, photo_path, requested_size, content_hash=None):
+        size = get_thumbnail_size(requested_size)
+        try:
+            thumbnail_path = self.get_thumbnail_path(photo_path, size, content_hash)
+        except OSError:
+            return QImage()
+
+        with self.lock:
+            entry = self.entries.get(thumbnail_path)
+        if entry is not None:
+            with span("load_thumbnail"):
+                image = QImage(thumbnail_path)
+            if not image.isNull():
+                count("thumbnail_cache_hits")
+                self.touch(thumbnail_path)
+                return image
+
+        with span("decode_thumbnail"):
+            image = self.decode_thumbnail(photo_path, size)
+        count("thumbnails_decoded")
+        if not image.isNull():
+            self.save_thumbnail(image, thumbnail_path)
+        return image
+
+    def save_thumbnail(self, image, thumbnail_path):
+        # Saved under a temporary name and renamed over, so concurrent saves of the same thumbnail
+        # can't interleave and a crash never leaves a truncated JPEG to be served
+        temporary_path = f"{thumbnail_path}.{threading.get_ident()}.part"
+        if not image.save(temporary_path, "JPG", 90):
+            try:
+                os.remove(temporary_path)
+            except FileNotFoundError:
+                pass
+            return
+        try:
+            os.replace(temporary_path, thumbnail_path)
+        except OSError:
+            os.remove(temporary_path)
+            return
+        self.add_entry(thumbnail_path)
+
+    def decode_thumbnail(self, photo_path, size):
+        # Decodes straight to the reduced size; JPEG readers can skip most of the full-resolution work
+        reader = QImageReader(photo_path)
+        reader.setAutoTransform(True)
+        original_size = reader.size()
+        if original_size.isValid() and (original_size.width() > size or original_size.height() > size):
+            reader.setScaledSize(original_size.scaled(size, size, Qt.AspectRatioMode.KeepAspectRatio))
+        return reader.read()
+
+    def touch(self, thumbnail_path):
+        try:
+            os.utime(thumbnail_path)
+            last_access = os.stat(thumbnail_path).st_mtime
+        except OSError:
+            return
+        with self.lock:
+            if thumbnail_path in self.entries:
+                self.entries[thumbnail_path][1] = last_access
+
+    def add_entry(self, thumbnail_path):
+        stat = os.stat(thumbnail_path)
+        with self.lock:
+            previous = self.entries.get(thumbnail_path)
+            if previous is not None:
+                self.total_bytes -= previous[0]
+            self.entries[thumbnail_path] = [stat.st_size, stat.st_mtime]
+            self.total_bytes += stat.st_size
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        # Least recently used first, down to 90% of the budget so eviction doesn't run on every insert
+        target_bytes = self.max_bytes * 0.9
+        for thumbnail_path, (byte_size, _) in sorted(self.entries.items(), key=lambda item: item[1][1]):
+            if self.total_bytes <= target_bytes:
+                break
+            try:
+                os.remove(thumbnail_path)
+            except FileNotFoundError:
+                pass
+            del self.entries[thumbnail_path]
+            self.total_bytes -= byte_size
@@ -0,0 +1,152 @@
+# On-disk cache of a gallery's built taxon tree and its initial layout, so reopening an unchanged
+# gallery skips the queries, the tree building and the label measuring. Headless, like tree_layout.
+#
+# File layout: magic, key length and key (JSON), then a zlib-compressed run of length-prefixed
+# columns. Numbers are stored as arrays, text as NUL-separated UTF-8.
+
+import os
+import json
+import zlib
+import struct
+from array import array
+from taxon_tree import TaxonNode
+from tree_layout import LayoutNode
+
+tree_cache_magic = b"ATC1"
+tree_cache_name = ".tree_cache"
+
+def get_tree_cache_path(photo_database_path, collapse_rank):
+    # Next to the gallery's thumbnails, one file per collapse rank, so the tree window and an
+    # expanded export don't overwrite each other's cache
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    database_name = os.path.splitext(os.path.basename(photo_database_path))[0]
+    return os.path.join(base_dir, 'images', database_name, f"{tree_cache_name}_{collapse_rank or 'expanded'}")
+
+def pack_numbers(typecode, values):
+    data = array(typecode, values).tobytes()
+    return struct.pack("<I", len(data)) + data
+
+def pack_strings(values):
+    data = "\0".join(values).encode("utf-8")
+    return struct.pack("<I", len(data)) + data
+
+class ColumnReader:
+    def __init__(self, payload):
+        self.payload = payload
+        self.offset = 0
+
+    def read_bytes(self):
+        length = struct.unpack_from("<I", self.payload, self.offset)[0]
+        self.offset += 4 + length
+        return self.payload[self.offset - length:self.offset]
+
+    def read_numbers(self, typecode):
+        values = array(typecode)
+        values.frombytes(self.read_bytes())
+        return values
+
+    def read_strings(self):
+        data = self.read_bytes()
+        return data.decode("utf-8").split("\0") if data else []
+
+def write_tree_cache(cache_path, key, tree_data, collapsed_nodes, layout_nodes, label_widths):
+    # Nodes in pre-order, each with the index of its parent, so children keep their order
+    nodes = []
+    node_indexes = {}
+    parent_indexes = []
+    stack = [(node, -1) for node in reversed(tree_data)]
+    while stack:
+        node, parent_index = stack.pop()
+        node_indexes[node.id] = len(nodes)
+        nodes.append(node)
+        parent_indexes.append(parent_index)
+        stack.extend((child, node_indexes[node.id]) for child in reversed(node.children))
+
+    layout_indexes = {id(layout_node): index for index, layout_node in enumerate(layout_nodes)}
+
+    columns = [
+        pack_numbers("q", [node.id for node in nodes]),
+        pack_numbers("i", parent_indexes),
+        pack_strings([node.taxon_name for node in nodes]),
+        pack_strings([node.taxon_rank for node in nodes]),
+        pack_numbers("B", [node.has_photos for node in nodes]),
+        pack_numbers("q", [node.photo_count for node in nodes]),
+        pack_numbers("q", [node.subtree_photo_count for node in nodes]),
+        pack_numbers("q", sorted(collapsed_nodes)),
+        # Layout nodes come in pre-order too, but collapsed subtrees are left out
+        pack_numbers("i", [node_indexes[layout_node.node.id] for layout_node in layout_nodes]),
+        pack_numbers("i", [-1 if layout_node.parent is None else layout_indexes[id(layout_node.parent)]
+                           for layout_node in layout_nodes]),
+        pack_numbers("i", [layout_node.depth for layout_node in layout_nodes]),
+        pack_numbers("d", [value for layout_node in layout_nodes
+                           for value in (layout_node.x, layout_node.y, layout_node.width, layout_node.height)]),
+        pack_strings(list(label_widths)),
+        pack_numbers("d", list(label_widths.values())),
+    ]
+
+    encoded_key = json.dumps(key, sort_keys=True).encode("utf-8")
+    # Written aside and renamed over, so a reader never sees half a cache
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    temporary_path = cache_path + ".tmp"
+    with open(temporary_path, "wb") as cache_file:
+        cache_file.write(tree_cache_magic + struct.pack("<I", len(encoded_key)) + encoded_key)
+        cache_file.write(zlib.compress(b"".join(columns), 1))
+    os.replace(temporary_path, cache_path)
+
+def read_tree_cache(cache_path, key):
+    # (tree_data, collapsed_nodes, layout_nodes, label_widths), or None when the cache is missing,
+    # was written for another key or can't be read
+    try:
+        with open(cache_path, "rb") as cache_file:
+            data = cache_file.read()
+    except OSError:
+        return None
+
+    encoded_key = json.dumps(key, sort_keys=True).encode("utf-8")
+    header = tree_cache_magic + struct.pack("<I", len(encoded_key)) + encoded_key
+    if not data.startswith(header):
+        return None
+    try:
+        columns = ColumnReader(zlib.decompress(data[len(header):]))
+        taxon_ids = columns.read_numbers("q")
+        parent_indexes = columns.read_numbers("i")
+        taxon_names = columns.read_strings()
+        taxon_ranks = columns.read_strings()
+        has_photos = columns.read_numbers("B")
+        photo_counts = columns.read_numbers("q")
+        subtree_photo_counts = columns.read_numbers("q")
+        collapsed_nodes = set(columns.read_numbers("q"))
+        layout_node_indexes = columns.read_numbers("i")
+        layout_parent_indexes = columns.read_numbers("i")
+        layout_depths = columns.read_numbers("i")
+        layout_boxes = columns.read_numbers("d")
+        labels = columns.read_strings()
+        widths = columns.read_numbers("d")
+    except (zlib.error, struct.error, ValueError, UnicodeDecodeError):
+        return None
+
+    nodes = []
+    tree_data = []
+    for index, taxon_id in enumerate(taxon_ids):
+        node = TaxonNode(taxon_id, taxon_names[index], taxon_ranks[index], bool(has_photos[index]),
+                         photo_counts[index], subtree_photo_counts[index])
+        nodes.append(node)
+        parent_index = parent_indexes[index]
+        if parent_index < 0:
+            tree_data.append(node)
+        else:
+            nodes[parent_index].children.append(node)
+
+    layout_nodes = []
+    for index, node_index in enumerate(layout_node_indexes):
+        parent_index = layout_parent_indexes[index]
+        parent = None if parent_index < 0 else layout_nodes[parent_index]
+        x, y, width, height = layout_boxes[4 * index:4 * index + 4]
+        layout_node = LayoutNode(nodes[node_index], parent, layout_depths[index], width, height)
+        layout_node.x = x
+        layout_node.y = y
+        layout_nodes.append(layout_node)
+        if parent is not None:
+            parent.children.append(layout_node)
+
+    return tree_data, collapsed_nodes, layout_nodes, dict(zip(labels, widths))
@@ -0,0 +1,184 @@
+# Headless layout for the phylogenetic tree. Works on any node with a `children` list,
+# so it runs (and can be tested) without a display.
+
+import math
+from bisect import bisect_left
+from instrumentation import timed
+
+# NCBI ranks from broadest to narrowest, used to decide where subtrees start collapsed
+taxon_ranks = [
+    "superkingdom", "kingdom", "subkingdom", "superphylum", "phylum", "subphylum",
+    "superclass", "class", "subclass", "infraclass", "cohort", "subcohort",
+    "superorder", "order", "suborder", "infraorder", "parvorder",
+    "superfamily", "family", "subfamily", "tribe", "subtribe",
+    "genus", "subgenus", "section", "subsection", "series",
+    "species group", "species subgroup", "species", "subspecies", "varietas", "forma"
+]
+
+def get_node_label(node):
+    # Photos in the whole subtree, where the node carries counts
+    photo_count = getattr(node, "subtree_photo_count", 0)
+    if photo_count:
+        return f"{node.taxon_rank}: {node.taxon_name} ({photo_count})"
+    return f"{node.taxon_rank}: {node.taxon_name}"
+
+class LayoutNode:
+    __slots__ = ("node", "parent", "children", "depth", "x", "y", "width", "height",
+                 "offset", "center", "right")
+
+    def __init__(self, node, parent, depth, width, height):
+        self.node = node
+        self.parent = parent
+        self.children = []
+        self.depth = depth
+        self.x = 0.0  # left edge of the box
+        self.y = 0.0  # top edge of the box
+        self.width = width
+        self.height = height
+        # Relative placement, filled in by the bottom-up pass
+        self.offset = 0.0  # left edge of this subtree in its parent's frame
+        self.center = 0.0  # box center in this subtree's own frame
+        self.right = 0.0  # right edge of this subtree in its own frame
+
+    @property
+    def x_center(self):
+        return self.x + self.width / 2
+
+def place_children(children, spacing, start=0.0):
+    # Lays sibling subtrees out side by side, each starting after the previous one's right edge
+    cursor = start
+    for child in children:
+        child.offset = cursor
+        cursor += child.right + spacing
+
+def get_collapsed_nodes(roots, collapse_rank):
+    # Ids of nodes at or below collapse_rank that have children, i.e. the subtrees that start folded
+    if collapse_rank is None or collapse_rank not in taxon_ranks:
+        return set()
+    collapse_level = taxon_ranks.index(collapse_rank)
+
+    collapsed = set()
+    stack = list(roots)
+    while stack:
+        node = stack.pop()
+        if not node.children:
+            continue
+        if node.taxon_rank in taxon_ranks and taxon_ranks.index(node.taxon_rank) >= collapse_level:
+            collapsed.add(node.id)
+            continue
+        stack.extend(node.children)
+    return collapsed
+
+@timed()
+def layout_tree(roots, label_width, box_height, level_height=75, sibling_spacing=50, x_start=0,
+                is_expanded=None):
+    # Returns LayoutNodes in pre-order. label_width(node) gives the box width of a node,
+    # box_height the shared box height. Nodes for which is_expanded(node) is False are laid
+    # out as leaves. Runs in O(n) without recursion.
+    layout_nodes = []
+    layout_roots = []
+    stack = [(root, None, 0) for root in reversed(roots)]
+    while stack:
+        node, parent, depth = stack.pop()
+        layout_node = LayoutNode(node, parent, depth, label_width(node), box_height)
+        layout_nodes.append(layout_node)
+        if parent is None:
+            layout_roots.append(layout_node)
+        else:
+            parent.children.append(layout_node)
+        if is_expanded is not None and not is_expanded(node):
+            continue
+        for child in reversed(node.children):
+            stack.append((child, layout_node, depth + 1))
+
+    # Bottom-up: children always come after their parent in pre-order
+    for layout_node in reversed(layout_nodes):
+        children = layout_node.children
+        half_width = layout_node.width / 2
+        if not children:
+            layout_node.center = half_width
+            layout_node.right = layout_node.width
+            continue
+
+        place_children(children, sibling_spacing)
+        first_center = children[0].offset + children[0].center
+        last_center = children[-1].offset + children[-1].center
+        center = (first_center + last_center) / 2
+
+        # A parent wider than its children's span pushes the children right instead of overlapping
+        # whatever sits to its left
+        if center - half_width < 0:
+            shift = half_width - center
+            for child in children:
+                child.offset += shift
+            center += shift
+
+        layout_node.center = center
+        layout_node.right = max(children[-1].offset + children[-1].right, center + half_width)
+
+    place_children(layout_roots, sibling_spacing, x_start)
+
+    # Top-down: turn relative offsets into absolute coordinates
+    for layout_node in layout_nodes:
+        parent_frame = 0.0 if layout_node.parent is None else layout_node.parent.offset
+        layout_node.offset += parent_frame
+        layout_node.x = layout_node.offset + layout_node.center - layout_node.width / 2
+        layout_node.y = layout_node.depth * level_height
+
+    return layout_nodes
+
+def get_layout_bounds(layout_nodes):
+    # (left, top, right, bottom) of all boxes
+    if not layout_nodes:
+        return 0.0, 0.0, 0.0, 0.0
+    return (
+        min(layout_node.x for layout_node in layout_nodes),
+        min(layout_node.y for layout_node in layout_nodes),
+        max(layout_node.x + layout_node.width for layout_node in layout_nodes),
+        max(layout_node.y + layout_node.height for layout_node in layout_nodes)
+    )
+
+class TreeLayoutIndex:
+    # Finds the nodes whose box or line up to their parent intersects a rectangle,
+    # so a renderer only has to create items for the visible region.
+    def __init__(self, layout_nodes, level_height):
+        self.level_height = level_height
+        self.box_height = max((layout_node.height for layout_node in layout_nodes), default=0)
+
+        level_entries = {}
+        for layout_node in layout_nodes:
+            left = layout_node.x
+            right = layout_node.x + layout_node.width
+            parent = layout_node.parent
+            if parent is not None:
+                left = min(left, parent.x_center)
+                right = max(right, parent.x_center)
+            level_entries.setdefault(layout_node.depth, []).append((left, right, layout_node))
+
+        # depth -> (lefts, running max of rights, nodes), sorted by left edge
+        self.levels = {}
+        for depth, entries in level_entries.items():
+            entries.sort(key=lambda entry: entry[0])
+            lefts = []
+            max_rights = []
+            max_right = -math.inf
+            for left, right, _ in entries:
+                lefts.append(left)
+                max_right = max(max_right, right)
+                max_rights.append(max_right)
+            self.levels[depth] = (lefts, max_rights, entries)
+
+    def query(self, left, top, right, bottom):
+        # A level's band runs from the bottom of the previous row of boxes to the bottom of its own
+        first_depth = max(0, math.floor((top - self.box_height) / self.level_height))
+        last_depth = math.floor(bottom / self.level_height) + 1
+        for depth in range(first_depth, last_depth + 1):
+            level = self.levels.get(depth)
+            if level is None:
+                continue
+            lefts, max_rights, entries = level
+            index = bisect_left(max_rights, left)
+            while index < len(entries) and lefts[index] <= right:
+                if entries[index][1] >= left:
+                    yield entries[index][2]
+                index += 1